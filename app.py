@@ -4,27 +4,38 @@ import streamlit as st
 import warnings
 
 from src.data.arpa.arpa_quality_raw_funcs import ArpaConnect, get_city_sensor_ids
-from src.visualization.visualize import display_plotly_timestamp, display_year_on_year_avg_pollutant, \
-    dist_values_from_series, reindex_data, summarize_sensors
-from src.data.common_funcs import load_dataset, load_normalized_dataset
+from src.visualization.dashboard import load_dashboard_index, load_dashboard_lines, load_avg_by_date, \
+    load_yearly_matrix
+from src.visualization.visualize import display_plotly_timestamp, display_year_on_year_from_averages
+
+DEFAULT_COMP_YEARS = [2019]
 
 
 @st.cache
-def get_sensor_registry(arpa):
-    sensor_data = get_city_sensor_ids(arpa=arpa, city='Milano')
+def get_sensor_registry():
+    """ The registry is served from the on-disk response cache of ArpaConnect, which only connects on a miss. """
+    sensor_data = get_city_sensor_ids(arpa=ArpaConnect(), city='Milano')
     return sensor_data
 
 
 @st.cache
-def load_raw_data():
-    raw_data = load_dataset()
-    return raw_data
+def load_lines(sensor_type, kind, since_year, built_at):
+    """ Dashboard aggregates are small and read as they are; built_at invalidates the cache when they are rebuilt. """
+    return load_dashboard_lines(sensor_type=sensor_type, kind=kind, since_year=since_year)
 
 
 @st.cache
-def load_norm_data():
-    norm_data = load_normalized_dataset()
-    return norm_data
+def load_yearly_avgs(sensor_type, kind, built_at):
+    """ Any set of comparison years is sliced from the years x day keys matrix, so it is loaded once per type. """
+    return (load_avg_by_date(sensor_type=sensor_type, kind=kind),
+            load_yearly_matrix(sensor_type=sensor_type, kind=kind))
+
+
+def display_lines(lines, since_year):
+    sens_cols = [c for c in lines.columns if c not in ['data', 'med']]
+    if len(sens_cols) == 0:
+        raise RuntimeError("No sensor available when data are filtered since year {y}".format(y=since_year))
+    display_plotly_timestamp(lines=lines, color_only_col='med', use_st=True)
 
 
 if __name__ == '__main__':
@@ -33,50 +44,30 @@ if __name__ == '__main__':
     warnings.filterwarnings('ignore')
 
     st.title("Covid-19 effect on pollution")
-    arpa = ArpaConnect()
-    sensor_registry = get_sensor_registry(arpa=arpa)
-    raw_data = load_raw_data()
-    norm_data = load_norm_data()
-    sensor_types = dist_values_from_series(raw_data['nometiposensore'], add_none='exclude')
-    selected_type = st.sidebar.selectbox('Filter by sensor type:', sensor_types)
-    since_year = st.sidebar.selectbox('See raw data since:', sorted(list(range(2010, 2021)), reverse=True))
-
-    selected_sensors = raw_data.loc[raw_data['nometiposensore'] == selected_type, 'idsensore'].unique().tolist()
-    selected_raw_data = raw_data[raw_data['idsensore'].isin(selected_sensors)]
-    selected_norm_data = norm_data[norm_data['idsensore'].isin(selected_sensors)]
+    sensor_registry = get_sensor_registry()
+    dashboard_index = load_dashboard_index()
+    built_at = dashboard_index['built_at']
+    selected_type = st.sidebar.selectbox('Filter by sensor type:', dashboard_index['sensor_types'])
+    since_year = st.sidebar.selectbox('See raw data since:', sorted(dashboard_index['since_years'], reverse=True))
+    comp_years = st.sidebar.multiselect('Compare with the mean of years:', dashboard_index['since_years'],
+                                        [y for y in DEFAULT_COMP_YEARS if y in dashboard_index['since_years']])
+    comp_label = ', '.join(str(y) for y in comp_years)
 
     if st.checkbox('show sensor registry:', False):
         st.table(sensor_registry.loc[sensor_registry['nometiposensore'] == selected_type])
 
     if st.checkbox('raw data: show pollutant timeline since ' + str(since_year), False):
-        last_year_selected_raw_data = selected_raw_data[selected_raw_data['data'].dt.year >= since_year]
-        lines_last_year_selected_raw_data = last_year_selected_raw_data.pivot_table(index='data', columns='idsensore',
-                                                                                    values='valore').reset_index()
-        lines_last_year_selected_raw_data = reindex_data(df=lines_last_year_selected_raw_data)
-        sens_cols = [c for c in selected_sensors if c in lines_last_year_selected_raw_data.columns]
-        if len(sens_cols) == 0:
-            raise RuntimeError(
-                "None of {l} available when data are filtered since year {y}".format(l=sens_cols, y=since_year))
-        lines_last_year_selected_raw_data['med'] = summarize_sensors(
-            lines=lines_last_year_selected_raw_data.set_index('data'),
-            na_per_sensor=0.3).values
-        display_plotly_timestamp(lines=lines_last_year_selected_raw_data, color_only_col='med', use_st=True)
-
-    if st.checkbox('raw data: show year on year comparison on 2019', True):
-        display_year_on_year_avg_pollutant(data=selected_raw_data, comp_year=2019, use_st=True)
+        display_lines(lines=load_lines(selected_type, 'raw', since_year, built_at), since_year=since_year)
+
+    if comp_years and st.checkbox('raw data: show year on year comparison on ' + comp_label, True):
+        raw_by_date, raw_matrix = load_yearly_avgs(selected_type, 'raw', built_at)
+        display_year_on_year_from_averages(by_date=raw_by_date, yearly_matrix=raw_matrix, comp_years=comp_years,
+                                           use_st=True)
 
     if st.checkbox('normalized data: show pollutant timeline since ' + str(since_year), False):
-        last_year_selected_norm_data = selected_norm_data[selected_norm_data['data'].dt.year >= since_year]
-        lines_last_year_selected_norm_data = last_year_selected_norm_data.pivot_table(index='data', columns='idsensore',
-                                                                                      values='valore').reset_index()
-        lines_last_year_selected_norm_data = reindex_data(df=lines_last_year_selected_norm_data)
-        sens_cols = [c for c in selected_sensors if c in lines_last_year_selected_norm_data.columns]
-        if len(sens_cols) == 0:
-            raise RuntimeError("None of {l} when data are filtered since year {y}".format(l=sens_cols, y=since_year))
-        lines_last_year_selected_norm_data['med'] = summarize_sensors(
-            lines=lines_last_year_selected_norm_data.set_index('data'),
-            na_per_sensor=0.3).values
-        display_plotly_timestamp(lines=lines_last_year_selected_norm_data, color_only_col='med', use_st=True)
-
-    if st.checkbox('normalized data: show year on year comparison on 2019', True):
-        display_year_on_year_avg_pollutant(data=selected_norm_data, comp_year=2019, use_st=True)
+        display_lines(lines=load_lines(selected_type, 'norm', since_year, built_at), since_year=since_year)
+
+    if comp_years and st.checkbox('normalized data: show year on year comparison on ' + comp_label, True):
+        norm_by_date, norm_matrix = load_yearly_avgs(selected_type, 'norm', built_at)
+        display_year_on_year_from_averages(by_date=norm_by_date, yearly_matrix=norm_matrix, comp_years=comp_years,
+                                           use_st=True)
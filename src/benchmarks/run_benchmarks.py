@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+sys.path.append(os.getcwd())
+warnings.filterwarnings('ignore')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on deterministic synthetic data")
+    parser.add_argument("-s", "--sensors", help="[4] number of selected sensors", type=int, default=4)
+    parser.add_argument("-y", "--years", help="[3] number of years of data", type=int, default=3)
+    parser.add_argument("-d", "--daily", help="[False] daily sensors are generated instead of hourly ones",
+                        default=False, action="store_true")
+    parser.add_argument("--hourly", help="[False] hourly sensors are kept by hour instead of being averaged by day",
+                        default=False, action="store_true")
+    parser.add_argument("-r", "--repeat", help="timed runs of each stage, plus one to measure memory",
+                        type=int, default=None)
+    parser.add_argument("--stages", nargs='+', default=None,
+                        help="only benchmark stages starting with these prefixes, e.g. ingest train.fit; "
+                             "earlier stages still run once, untimed, to feed the selected ones")
+    parser.add_argument("-o", "--output", help="json file of results, written to reports/benchmarks by default",
+                        default=None)
+    parser.add_argument("-c", "--compare", help="json file of a previous run to compare results with", default=None)
+    parser.add_argument("--data_dir", default=None,
+                        help="directory for synthetic data, a temporary one by default; the real data directory "
+                             "is never touched")
+    return parser.parse_args()
+
+
+def measure_stage(func, context: dict, repeat: int) -> tuple:
+    """
+    Run func(context) repeat times to time it with a monotonic clock, then once more under tracemalloc to measure the
+    peak of memory allocated by the stage. Return the timings and the output of the last run.
+    """
+    wall_seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(context)
+        wall_seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    output = func(context)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {
+        'wall_seconds': wall_seconds,
+        'median_seconds': statistics.median(wall_seconds),
+        'min_seconds': min(wall_seconds),
+        'peak_memory_mb': peak_bytes / 2 ** 20
+    }
+    if hasattr(output, '__len__') and not isinstance(output, tuple):
+        result['rows_out'] = len(output)
+    return result, output
+
+
+def run_benchmarks(synthetic, repeat: int, hourly: bool = False, stage_prefixes: list = None) -> dict:
+    from src.benchmarks.stages import STAGES, prepare_inputs
+    logging.info("writing synthetic inputs {d}".format(d=synthetic.describe()))
+    context = prepare_inputs(synthetic=synthetic, hourly=hourly)
+    selected = [name for name, _, _ in STAGES
+                if stage_prefixes is None or any(name.startswith(p) for p in stage_prefixes)]
+    last_selected = max([i for i, (name, _, _) in enumerate(STAGES) if name in selected], default=-1)
+    results = {}
+    for name, func, prepare in STAGES[:last_selected + 1]:
+        if prepare is not None:
+            prepare(context)
+        if name not in selected:
+            context[name] = func(context)
+            continue
+        logging.info("benchmarking stage {s}".format(s=name))
+        results[name], context[name] = measure_stage(func=func, context=context, repeat=repeat)
+        logging.info("{s}: {t:.3f} s, {m:.1f} MB".format(s=name, t=results[name]['median_seconds'],
+                                                         m=results[name]['peak_memory_mb']))
+    return results
+
+
+def run_metadata(synthetic, repeat: int, hourly: bool) -> dict:
+    import numpy as np
+    import pandas as pd
+    import sklearn
+    return {
+        'started_at': datetime.datetime.now().isoformat(),
+        'synthetic': synthetic.describe(),
+        'hourly_dataset': hourly,
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__}
+    }
+
+
+def compare_results(results: dict, baseline: dict) -> list:
+    """ Ratio of median time and peak memory of each stage to those of baseline, above 1 if slower or bigger. """
+    lines = ["{s:<26}{t:>12}{tr:>8}{m:>12}{mr:>8}".format(s='stage', t='seconds', tr='ratio', m='MB', mr='ratio')]
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        time_ratio = result['median_seconds'] / base['median_seconds'] if base else float('nan')
+        memory_ratio = result['peak_memory_mb'] / base['peak_memory_mb'] if base and base['peak_memory_mb'] else \
+            float('nan')
+        lines.append("{s:<26}{t:>12.3f}{tr:>8.2f}{m:>12.1f}{mr:>8.2f}".format(
+            s=name, t=result['median_seconds'], tr=time_ratio, m=result['peak_memory_mb'], mr=memory_ratio))
+    return lines
+
+
+def main(sensors: int, years: int, use_daily: bool = False, hourly: bool = False, repeat: int = None,
+         stage_prefixes: list = None, output: str = None, compare: str = None) -> dict:
+    from src.config import BENCHMARK_REPEAT, BENCHMARK_OUTPUT_DIR
+    from src.benchmarks.synthetic import SyntheticData
+    if repeat is None:
+        repeat = BENCHMARK_REPEAT
+    synthetic = SyntheticData(n_sensors=sensors, n_years=years, hourly=not use_daily)
+    report = {'metadata': run_metadata(synthetic=synthetic, repeat=repeat, hourly=hourly)}
+    report['results'] = run_benchmarks(synthetic=synthetic, repeat=repeat, hourly=hourly,
+                                       stage_prefixes=stage_prefixes)
+    if output is None:
+        output = os.path.join(BENCHMARK_OUTPUT_DIR, 'benchmark_{t}.json'.format(
+            t=datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info("benchmark results saved to {p}".format(p=output))
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+        if baseline['metadata']['synthetic'] != report['metadata']['synthetic']:
+            logging.warning("baseline was run on different synthetic data {d}".format(
+                d=baseline['metadata']['synthetic']))
+        print("\n".join(compare_results(results=report['results'], baseline=baseline)))
+    return report
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix='pollution_benchmark_') as tmp_dir:
+        # data directories are read from the environment when src.config is first imported, so every stage reads
+        # and writes synthetic data only
+        os.environ['POLLUTION_DATA_DIR'] = os.path.abspath(args.data_dir or tmp_dir)
+        main(sensors=args.sensors, years=args.years, use_daily=args.daily, hourly=args.hourly, repeat=args.repeat,
+             stage_prefixes=args.stages, output=args.output, compare=args.compare)
@@ -0,0 +1,139 @@
+import os
+
+import pandas as pd
+
+from src.config import ARPA_DATA_DIR, WT_DATA_DIR, PROC_DATA_DIR
+from src.benchmarks.synthetic import SyntheticData
+from src.data.arpa.arpa_quality_raw_funcs import read_sensor_archives, clean_current_sensor_df, _typed_page
+from src.data.common_funcs import create_dataset, save_dataset
+from src.data.storage import save_frame
+from src.data.weather.weather_raw_funcs import create_weather_df
+from src.features.arpa_features import aggregate_by_period
+from src.features.build_features import join_date_features
+from src.features.date_dimension import build_date_dimension
+from src.models.train_model import x_y_split, bootstrap_normalization, _normalization_model, \
+    pipeline_normalize_multi_sensors
+from src.visualization.dashboard import build_dashboard_aggregates
+from src.visualization.visualize import get_yearly_avg, summarize_sensors, yearly_avg_matrix
+
+
+def prepare_inputs(synthetic: SyntheticData, hourly: bool = False) -> dict:
+    """
+    Write raw files and processed datasets of synthetic into the configured data directories and return the context
+    shared by stages. Nothing here is timed.
+    The dataset is built as by make_dataset: from daily sensors if synthetic is daily, otherwise from hourly sensors
+    averaged by day, or kept by hour if hourly is True.
+    """
+    os.makedirs(PROC_DATA_DIR, exist_ok=True)
+    arpa_data, weather_data = synthetic.arpa_data(), synthetic.weather_data()
+    save_frame(arpa_data, name='arpa_data')
+    save_frame(weather_data, name='weather_data')
+    return {
+        'use_daily': not synthetic.hourly,
+        'hourly': hourly and synthetic.hourly,
+        'id_data': synthetic.id_data(),
+        'archive_paths': synthetic.write_arpa_archives(data_dir=ARPA_DATA_DIR),
+        'weather_paths': synthetic.write_weather_csv(data_dir=WT_DATA_DIR),
+        'records': synthetic.socrata_records(),
+        'arpa_data': arpa_data,
+        'weather_data': weather_data
+    }
+
+
+def _ingest_archives(context: dict) -> pd.DataFrame:
+    return pd.concat(read_sensor_archives(paths=context['archive_paths'], id_data=context['id_data'], n_workers=1))
+
+
+def _ingest_socrata(context: dict) -> pd.DataFrame:
+    page_df = _typed_page(pd.DataFrame.from_records(context['records']))
+    return clean_current_sensor_df(sensor_df=page_df, id_data=context['id_data'])
+
+
+def _ingest_weather(context: dict) -> pd.DataFrame:
+    return create_weather_df(data_dir=WT_DATA_DIR, n_workers=1)
+
+
+def _aggregate(context: dict) -> pd.DataFrame:
+    return aggregate_by_period(arpa_df=context['arpa_data'], period='h' if context['hourly'] else 'D')
+
+
+def _date_dimension(context: dict) -> pd.DataFrame:
+    return build_date_dimension(weather_df=context['weather_data'], hourly=context['hourly'])
+
+
+def _create_dataset(context: dict) -> tuple:
+    return create_dataset(use_daily=context['use_daily'], hourly=context['hourly'])
+
+
+def _prepare_sensor(context: dict):
+    facts, date_dimension = context['features.dataset']
+    sensor = facts['idsensore'].iloc[0]
+    context['sensor_facts'] = facts.loc[facts['idsensore'] == sensor]
+
+
+def _sensor_features(context: dict) -> pd.DataFrame:
+    return join_date_features(facts=context['sensor_facts'], date_dimension=context['features.dataset'][1])
+
+
+def _prepare_fit(context: dict):
+    context['x'], context['y'] = x_y_split(dataset=context['features.sensor'])
+
+
+def _fit(context: dict):
+    norm_model = _normalization_model(random_state=0, hourly=context['hourly'])
+    return norm_model.fit(context['x'], context['y'])
+
+
+def _bootstrap(context: dict) -> pd.DataFrame:
+    return bootstrap_normalization(model=context['train.fit'], x=context['x'], random_state=0)
+
+
+def _prepare_pipeline(context: dict):
+    facts, date_dimension = context['features.dataset']
+    save_dataset(dataset=facts, date_dimension=date_dimension)
+
+
+def _pipeline(context: dict):
+    pipeline_normalize_multi_sensors(executor='serial', random_state=0, incremental=False)
+
+
+def _prepare_viz(context: dict):
+    context['viz_data'] = context['features.dataset'][0][['data', 'idsensore', 'valore']]
+
+
+def _viz_yearly_avg(context: dict) -> pd.Series:
+    viz_data = context['viz_data']
+    return get_yearly_avg(data=viz_data, year=viz_data['data'].dt.year.max())
+
+
+def _viz_yearly_matrix(context: dict) -> pd.DataFrame:
+    return yearly_avg_matrix(data=context['viz_data'])
+
+
+def _viz_summarize(context: dict) -> pd.Series:
+    lines = context['viz_data'].pivot_table(index='data', columns='idsensore', values='valore')
+    return summarize_sensors(lines=lines)
+
+
+def _viz_dashboard(context: dict) -> dict:
+    return build_dashboard_aggregates()
+
+
+# (name, timed function, untimed preparation run once before timing); the output of each stage is stored in the
+# context under its name, so later stages can use it
+STAGES = [
+    ('ingest.arpa_archives', _ingest_archives, None),
+    ('ingest.socrata_page', _ingest_socrata, None),
+    ('ingest.weather_csv', _ingest_weather, None),
+    ('features.aggregate', _aggregate, None),
+    ('features.date_dimension', _date_dimension, None),
+    ('features.dataset', _create_dataset, None),
+    ('features.sensor', _sensor_features, _prepare_sensor),
+    ('train.fit', _fit, _prepare_fit),
+    ('train.bootstrap', _bootstrap, None),
+    ('train.pipeline', _pipeline, _prepare_pipeline),
+    ('viz.yearly_avg', _viz_yearly_avg, _prepare_viz),
+    ('viz.yearly_matrix', _viz_yearly_matrix, None),
+    ('viz.summarize', _viz_summarize, None),
+    ('viz.dashboard', _viz_dashboard, None)
+]
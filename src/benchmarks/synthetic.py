@@ -0,0 +1,181 @@
+import io
+import os
+import zipfile
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from src.config import ARPA_MEASURES_FREQ, ARPA_CSV_DATE_FORMAT, ARPA_SCHEMA, WEATHER_SCHEMA, WT_CSV_ENCODING, \
+    ITA_MONTHS, BENCHMARK_SEED, BENCHMARK_START_YEAR
+from src.data.schema import apply_schema
+from src.data.weather.weather_raw_funcs import _clean_cols
+
+WT_CSV_HEADER = ['LOCALITA', 'DATA', 'TMEDIA °C', 'TMIN °C', 'TMAX °C', 'PUNTORUGIADA °C', 'UMIDITA %',
+                 'VISIBILITA km', 'VENTOMEDIA km/h', 'VENTOMAX km/h', 'RAFFICA km/h', 'PRESSIONESLM mb',
+                 'PRESSIONEMEDIA mb', 'PIOGGIA mm', 'FENOMENI']
+WT_EVENTS = ['', 'pioggia', 'nebbia', 'pioggia nebbia', 'neve', 'temporale pioggia', 'grandine temporale']
+
+
+class SyntheticData:
+    """
+    Deterministic generator of every input of the pipeline, at a configurable scale: n_sensors selected sensors
+    measured for n_years starting from start_year, hourly or daily. Yearly ARPA archives also hold the rows of
+    n_other_sensors that are not selected, as the real ones hold every sensor of the region.
+    The same seed always gives the same data, so benchmark runs on different code versions are comparable.
+    """
+
+    def __init__(self, n_sensors: int = 4, n_years: int = 3, hourly: bool = True, n_other_sensors: int = None,
+                 start_year: int = None, seed: int = None, station: str = 'Milano'):
+        if n_other_sensors is None:
+            n_other_sensors = n_sensors
+        if start_year is None:
+            start_year = BENCHMARK_START_YEAR
+        if seed is None:
+            seed = BENCHMARK_SEED
+        self.n_sensors = n_sensors
+        self.n_years = n_years
+        self.hourly = hourly
+        self.n_other_sensors = n_other_sensors
+        self.start_year = start_year
+        self.seed = seed
+        self.station = station
+
+    @property
+    def years(self) -> list:
+        return list(range(self.start_year, self.start_year + self.n_years))
+
+    def _rng(self, *salt) -> np.random.Generator:
+        return np.random.default_rng([self.seed] + [zlib.crc32(str(s).encode()) for s in salt])
+
+    def id_data(self, with_others: bool = False) -> pd.DataFrame:
+        """ Sensor registry: selected sensors come first, cycling through sensor types of the configured frequency. """
+        sensor_types = ARPA_MEASURES_FREQ['hourly' if self.hourly else 'daily']
+        n_sensors = self.n_sensors + (self.n_other_sensors if with_others else 0)
+        return pd.DataFrame({
+            'idsensore': [str(10000 + i) for i in range(n_sensors)],
+            'nometiposensore': [sensor_types[i % len(sensor_types)] for i in range(n_sensors)],
+            'idstazione': [str(500 + i // len(sensor_types)) for i in range(n_sensors)]
+        })
+
+    def _dates(self, year: int) -> pd.DatetimeIndex:
+        n_days = (pd.Timestamp(str(year + 1)) - pd.Timestamp(str(year))).days
+        if self.hourly:
+            return pd.date_range(str(year), periods=24 * n_days, freq=pd.offsets.Hour())
+        return pd.date_range(str(year), periods=n_days, freq=pd.offsets.Day())
+
+    def measures(self, year: int, with_others: bool = False) -> pd.DataFrame:
+        """
+        Measures of a year with the columns of the Socrata dataset: a yearly and a daily cycle plus gamma noise,
+        with about 1% of missing values (-9999).
+        """
+        id_data = self.id_data(with_others=with_others)
+        dates = self._dates(year)
+        rng = self._rng('measures', year, with_others)
+        n_dates = len(dates)
+        day_of_year = dates.dayofyear.to_numpy()
+        hour = dates.hour.to_numpy()
+        season = 1 + 0.5 * np.cos(2 * np.pi * day_of_year / 365.24) + 0.2 * np.sin(2 * np.pi * hour / 24)
+        valore = rng.gamma(4, 8, (len(id_data), n_dates)) * season
+        valore[rng.random(valore.shape) < 0.01] = -9999
+        return pd.DataFrame({
+            'idsensore': np.repeat(id_data['idsensore'].to_numpy(), n_dates),
+            'data': np.tile(dates.to_numpy(), len(id_data)),
+            'valore': valore.ravel().round(1),
+            'stato': 'VA',
+            'idoperatore': '1'
+        })
+
+    def write_arpa_archives(self, data_dir: str) -> list:
+        """ Write a zipped csv per year in the format of ARPA yearly archives, return their paths. """
+        os.makedirs(data_dir, exist_ok=True)
+        paths = []
+        for year in self.years:
+            measures = self.measures(year=year, with_others=True)
+            archive_df = pd.DataFrame({
+                'IdSensore': measures['idsensore'],
+                'Data': measures['data'].dt.strftime(ARPA_CSV_DATE_FORMAT),
+                'Valore': measures['valore'],
+                'Stato': measures['stato'],
+                'idOperatore': measures['idoperatore']
+            })
+            path = os.path.join(data_dir, '{y}.zip'.format(y=year))
+            with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('{y}.csv'.format(y=year), archive_df.to_csv(index=False))
+            paths.append(path)
+        return paths
+
+    def socrata_records(self, year: int = None) -> list:
+        """ Measures of the selected sensors in a year (the last one by default) as records of the Socrata API. """
+        if year is None:
+            year = self.years[-1]
+        measures = self.measures(year=year)
+        records_df = measures.assign(data=measures['data'].dt.strftime('%Y-%m-%dT%H:%M:%S.000')).astype(str)
+        return records_df.to_dict(orient='records')
+
+    def weather(self, year: int, month: int) -> pd.DataFrame:
+        """ Daily weather of a month for the station, with the raw column names of ilmeteo csv. """
+        dates = pd.date_range('{y}-{m:02d}-01'.format(y=year, m=month), periods=31, freq='D')
+        dates = dates[dates.month == month]
+        rng = self._rng('weather', year, month)
+        n_days = len(dates)
+        t_mean = 13 - 10 * np.cos(2 * np.pi * dates.dayofyear.to_numpy() / 365.24) + rng.normal(0, 3, n_days)
+        return pd.DataFrame({
+            'LOCALITA': self.station,
+            'DATA': dates.strftime('%d/%m/%Y'),
+            'TMEDIA °C': t_mean.round(0),
+            'TMIN °C': (t_mean - rng.uniform(2, 6, n_days)).round(0),
+            'TMAX °C': (t_mean + rng.uniform(2, 6, n_days)).round(0),
+            'PUNTORUGIADA °C': (t_mean - rng.uniform(0, 8, n_days)).round(0),
+            'UMIDITA %': rng.uniform(30, 100, n_days).round(0),
+            'VISIBILITA km': rng.uniform(1, 20, n_days).round(1),
+            'VENTOMEDIA km/h': rng.gamma(2, 3, n_days).round(0),
+            'VENTOMAX km/h': rng.gamma(3, 5, n_days).round(0),
+            'RAFFICA km/h': rng.gamma(3, 8, n_days).round(0),
+            'PRESSIONESLM mb': rng.normal(1015, 8, n_days).round(0),
+            'PRESSIONEMEDIA mb': rng.normal(1000, 8, n_days).round(0),
+            'PIOGGIA mm': np.where(rng.random(n_days) < 0.3, rng.gamma(1, 5, n_days), 0).round(1),
+            'FENOMENI': rng.choice(WT_EVENTS, n_days)
+        }, columns=WT_CSV_HEADER)
+
+    def write_weather_csv(self, data_dir: str) -> list:
+        """ Write a csv per month in the format of ilmeteo monthly downloads, return their paths. """
+        os.makedirs(data_dir, exist_ok=True)
+        paths = []
+        for year in self.years:
+            for month in range(1, 13):
+                buffer = io.StringIO()
+                self.weather(year=year, month=month).to_csv(buffer, sep=';', decimal=',', index=False)
+                ita_month = ITA_MONTHS['{:02d}'.format(month)]
+                path = os.path.join(data_dir, 'weather_{s}_{y}_{m}.csv'.format(s=self.station, y=year, m=ita_month))
+                with open(path, 'wb') as f:
+                    f.write(buffer.getvalue().encode(WT_CSV_ENCODING))
+                paths.append(path)
+        return paths
+
+    def arpa_data(self) -> pd.DataFrame:
+        """ Processed ARPA data of the selected sensors, as saved by make_arpa. """
+        id_data = self.id_data().drop_duplicates('idsensore').set_index('idsensore')
+        measures = pd.concat([self.measures(year=year) for year in self.years], ignore_index=True)
+        measures = measures.loc[measures['valore'] != -9999].drop(columns='idoperatore')
+        measures = measures.assign(nometiposensore=measures['idsensore'].map(id_data['nometiposensore']),
+                                   idstazione=measures['idsensore'].map(id_data['idstazione']))
+        return apply_schema(measures.reset_index(drop=True), schema=ARPA_SCHEMA)
+
+    def weather_data(self) -> pd.DataFrame:
+        """ Processed weather data, as saved by make_weather. """
+        weather_df = pd.concat([self.weather(year=year, month=month) for year in self.years for month in range(1, 13)],
+                               ignore_index=True)
+        weather_df.columns = [_clean_cols(c) for c in weather_df.columns]
+        weather_df['data'] = pd.to_datetime(weather_df['data'], format='%d/%m/%Y')
+        return apply_schema(weather_df, schema=WEATHER_SCHEMA)
+
+    def describe(self) -> dict:
+        return {
+            'n_sensors': self.n_sensors,
+            'n_other_sensors': self.n_other_sensors,
+            'n_years': self.n_years,
+            'hourly': self.hourly,
+            'start_year': self.start_year,
+            'seed': self.seed
+        }
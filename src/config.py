@@ -2,7 +2,7 @@ import os
 from pathlib import Path
 
 PROJECT_DIR = Path(__file__).resolve().parents[1]
-DATA_DIR = os.path.join(PROJECT_DIR, 'data')
+DATA_DIR = os.environ.get('POLLUTION_DATA_DIR', os.path.join(PROJECT_DIR, 'data'))
 RAW_DATA_DIR = os.path.join(DATA_DIR, 'raw')
 PROC_DATA_DIR = os.path.join(DATA_DIR, 'processed')
 
@@ -10,6 +10,15 @@ AQ_DATA_DIR = os.path.join(RAW_DATA_DIR, 'aqicn')
 WT_DATA_DIR = os.path.join(RAW_DATA_DIR, 'weather')
 ARPA_DATA_DIR = os.path.join(RAW_DATA_DIR, 'arpa_quality')
 
+STORAGE_BACKEND = 'parquet'
+STORAGE_PARTITIONS = {
+    'arpa_data': ['year', 'nometiposensore'],
+    'weather_data': ['year'],
+    'dataset': ['year', 'nometiposensore'],
+    'date_dimension': [],
+    'normalized_dataset': ['year']
+}
+
 AQ_COLS = ['pm25', 'pm10', 'o3', 'no2', 'so2', 'co']
 DT_ID_COLS = ['station_name', 'month', 'day']
 # DT_ID_COLS = ['station_name', 'weekofyear', 'wday']
@@ -17,6 +26,14 @@ DT_ID_COLS = ['station_name', 'month', 'day']
 WT_STATIONS = ['Milano']
 WT_BASE_URL = "https://www.ilmeteo.it/portale/archivio-meteo/"
 WT_START_YEAR = '2005'
+WT_CSV_ENCODING = 'cp1252'
+WT_CSV_DATE_FORMAT = '%d/%m/%Y'
+WT_PARSE_WORKERS = None
+WT_MANIFEST_PATH = os.path.join(PROC_DATA_DIR, 'weather_manifest.json')
+WT_DOWNLOAD_WORKERS = 4
+WT_DOWNLOAD_RETRIES = 3
+WT_DOWNLOAD_BACKOFF_SECONDS = 2
+WT_DOWNLOAD_TIMEOUT = 30
 ITA_MONTHS = {
     "01": "Gennaio",
     "02": "Febbraio",
@@ -35,6 +52,23 @@ ITA_MONTHS = {
 ARPA_REG_DATA_ID = 'ib47-atvt'
 ARPA_MEASURES_DATA_ID = 'nicp-bhqi'
 ARPA_STATIONS = ['Milano']
+ARPA_CSV_CHUNKSIZE = 500000
+ARPA_CSV_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+ARPA_HISTORY_WORKERS = None
+ARPA_HISTORY_MAX_MEMORY_MB = 4096
+ARPA_SHARD_DIR = os.path.join(ARPA_DATA_DIR, 'shards')
+SOCRATA_PAGE_SIZE = 50000
+SOCRATA_MAX_WORKERS = 4
+SOCRATA_RETRIES = 3
+SOCRATA_BACKOFF_SECONDS = 2
+SOCRATA_TIMEOUT = 60
+SOCRATA_CACHE_DIR = os.path.join(RAW_DATA_DIR, 'socrata_cache')
+# seconds a cached response of each dataset is served without asking the backend; datasets not listed are not cached
+SOCRATA_CACHE_TTL = {
+    ARPA_REG_DATA_ID: 24 * 3600
+}
+ARPA_WATERMARK_PATH = os.path.join(PROC_DATA_DIR, 'arpa_watermarks.json')
+ARPA_SYNC_OVERLAP_HOURS = 48
 ARPA_MEASURES_FREQ = {
     'hourly': ['Ossidi di Azoto', 'Biossido di Azoto', 'Biossido di Zolfo', 'Ozono',
                'Ammoniaca', 'Monossido di Carbonio', 'Benzene', 'Benzo(a)pirene',
@@ -70,11 +104,54 @@ FEAT_MONTH_COLS = ['January', 'February', 'March', 'April', 'May', 'June', 'July
                    'November', 'December']
 FEAT_WEEK_COLS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
 FEAT_DATE_COLS = FEAT_CAL_COLS + FEAT_MONTH_COLS + FEAT_WEEK_COLS
+FEAT_HARMONIC_PERIODS = [(7, 3), (365.24, 3)]
+FEAT_HOUR_HARMONIC_PERIODS = [(24, 3)]
+FEATURE_STORE_ENABLED = True
+FEATURE_STORE_DIR = os.path.join(PROC_DATA_DIR, 'features')
+FEATURE_STORE_MAX_MB = 2048
+
+ARPA_SCHEMA = {
+    'idsensore': 'category',
+    'idstazione': 'category',
+    'nometiposensore': 'category',
+    'stato': 'Int8',
+    'valore': 'float32'
+}
+WEATHER_SCHEMA = dict({'localita': 'category', 'fenomeni': 'category'}, **{c: 'float32' for c in FEAT_WEATHER_COLS})
+DATASET_SCHEMA = dict(ARPA_SCHEMA, **WEATHER_SCHEMA)
+DATASET_FACT_COLS = ['idsensore', 'data', 'valore', 'stato', 'nometiposensore', 'idstazione']
 
 RANDOM_FOREST_CONFIG = {
     'n_estimators': 20
 }
 BOOTSTRAP_SAMPLES = 500
+BOOTSTRAP_CHUNK_SIZE = 50
+BOOTSTRAP_QUANTILES = (0.05, 0.95)
+BOOTSTRAP_RESERVOIR_SIZE = 200
+BOOTSTRAP_MAX_BATCH_MB = 256
+BOOTSTRAP_RESERVOIR_MAX_MB = 64
+NORMALIZATION_SEED = 42
+NORMALIZATION_EXECUTOR = 'serial'
+NORMALIZATION_WORKERS = None
+NORMALIZATION_INCREMENTAL = True
+NORM_STATE_DIR = os.path.join(PROC_DATA_DIR, 'normalization_state')
+NORM_REFIT_DAYS = 30
+NORM_DRIFT_THRESHOLD = 1.0
+MODEL_REGISTRY_DIR = os.path.join(PROC_DATA_DIR, 'models')
+MODEL_REGISTRY_MAX_RESIDENT = 8
+
+PIPELINE_STATE_PATH = os.path.join(PROC_DATA_DIR, 'pipeline_state.json')
+PIPELINE_WORKERS = 2
+DASHBOARD_DIR = os.path.join(PROC_DATA_DIR, 'dashboard')
+DASHBOARD_NA_PER_SENSOR = 0.3
+RUN_REPORT_DIR = os.path.join(PROJECT_DIR, 'reports', 'runs')
+PROFILE_ENV_VAR = 'POLLUTION_PROFILE'
+PROFILE_TOP_N = 30
+
+BENCHMARK_SEED = 0
+BENCHMARK_START_YEAR = 2015
+BENCHMARK_REPEAT = 3
+BENCHMARK_OUTPUT_DIR = os.path.join(PROJECT_DIR, 'reports', 'benchmarks')
 
 FOLIUM_CFG = {
     'location': [45.4646602, 9.1889546],
@@ -1,22 +1,53 @@
+import datetime
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 import pandas as pd
+from requests.adapters import HTTPAdapter
 from sodapy import Socrata
 from pathlib import Path
 from dotenv import load_dotenv
 
-from src.config import PROJECT_DIR, ARPA_DATA_DIR, ARPA_REG_DATA_ID, ARPA_MEASURES_DATA_ID, PROC_DATA_DIR, ARPA_STATIONS
+from src.config import PROJECT_DIR, ARPA_DATA_DIR, ARPA_REG_DATA_ID, ARPA_MEASURES_DATA_ID, ARPA_STATIONS, \
+    ARPA_SCHEMA, ARPA_CSV_CHUNKSIZE, ARPA_CSV_DATE_FORMAT, ARPA_HISTORY_WORKERS, ARPA_HISTORY_MAX_MEMORY_MB, \
+    ARPA_SHARD_DIR, SOCRATA_PAGE_SIZE, SOCRATA_MAX_WORKERS, SOCRATA_RETRIES, SOCRATA_BACKOFF_SECONDS, SOCRATA_TIMEOUT, \
+    SOCRATA_CACHE_DIR, SOCRATA_CACHE_TTL, ARPA_WATERMARK_PATH, ARPA_SYNC_OVERLAP_HOURS
+from src.data.schema import apply_schema
+from src.data.storage import save_frame, upsert_frame, drop_stored_rows, load_frame, dataset_path, \
+    file_sha256
 
 
 class ArpaConnect:
     """
     Simple connector to Socrata API used to get current ARPA air quality open data.
-    Connection parameters are written into .env private file.
+    Connection parameters are written into .env private file. ARPA_URI_PREFIX can be set to 'http://' to point
+    ARPA_WEB_DOMAIN to a local stand-in of the Socrata backend.
+    The backend is only connected on first request not served by the response cache (see get_df).
     """
 
-    def __init__(self):
+    def __init__(self, cache_dir: str = None, cache_ttl: dict = None):
+        if cache_dir is None:
+            cache_dir = SOCRATA_CACHE_DIR
+        if cache_ttl is None:
+            cache_ttl = SOCRATA_CACHE_TTL
         self.params_dict = {}
-        self._init_connection()
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self._connector = None
+        self._connector_lock = threading.Lock()
+
+    @property
+    def connector(self) -> Socrata:
+        with self._connector_lock:
+            if self._connector is None:
+                self._init_connection()
+        return self._connector
 
     def _init_connection(self):
         load_dotenv(Path(PROJECT_DIR) / '.env')
@@ -27,10 +58,14 @@ class ArpaConnect:
             'username': os.environ.get('ARPA_USER_NAME'),
             'password': os.environ.get('ARPA_PWD')
         }
-        self.connector = Socrata(**self.params_dict)
+        session_adapter = {
+            'prefix': os.environ.get('ARPA_URI_PREFIX', 'https://'),
+            'adapter': HTTPAdapter(pool_maxsize=SOCRATA_MAX_WORKERS)
+        }
+        self._connector = Socrata(**self.params_dict, session_adapter=session_adapter, timeout=SOCRATA_TIMEOUT)
         logging.info("Backend connected")
 
-    def get_df(self, dataset_identifier, **kwargs):
+    def _download_df(self, dataset_identifier, **kwargs) -> pd.DataFrame:
         logging.info("Download from Socrata dataset {d} {kw}".format(d=dataset_identifier,
                                                                      kw="with kwargs " + str(kwargs) if len(
                                                                          kwargs) > 0 else ""))
@@ -38,6 +73,66 @@ class ArpaConnect:
         results_df = pd.DataFrame.from_records(results)
         return results_df
 
+    def _cache_path(self, dataset_identifier, **kwargs) -> str:
+        query = json.dumps(kwargs, sort_keys=True, default=str)
+        key = hashlib.sha256('{d}?{q}'.format(d=dataset_identifier, q=query).encode()).hexdigest()
+        return os.path.join(self.cache_dir, '{d}_{k}'.format(d=dataset_identifier, k=key[:16]))
+
+    def _rows_updated_at(self, dataset_identifier) -> int:
+        return self.connector.get_metadata(dataset_identifier).get('rowsUpdatedAt')
+
+    def get_df(self, dataset_identifier, **kwargs):
+        """
+        Get the records of the query as a dataframe. Responses of datasets listed in cache_ttl are cached on disk by
+        dataset and query: within the ttl they are served without connecting, afterwards they are revalidated against
+        the rowsUpdatedAt metadata of the dataset and downloaded again only if its rows changed. If the backend cannot
+        be reached, the cached response is served whatever its age.
+        """
+        ttl = self.cache_ttl.get(dataset_identifier)
+        if ttl is None:
+            return self._download_df(dataset_identifier, **kwargs)
+        cache_path = self._cache_path(dataset_identifier, **kwargs)
+        entry = _load_cache_entry(cache_path=cache_path)
+        if entry is not None and time.time() - entry['fetched_at'] < ttl:
+            return pd.read_pickle(cache_path + '.pkl')
+        try:
+            rows_updated_at = self._rows_updated_at(dataset_identifier)
+            if entry is not None and rows_updated_at is not None and entry['rows_updated_at'] == rows_updated_at:
+                logging.info("Cached response of Socrata dataset {d} is still current".format(d=dataset_identifier))
+                results_df = pd.read_pickle(cache_path + '.pkl')
+            else:
+                results_df = self._download_df(dataset_identifier, **kwargs)
+        except Exception as e:
+            if entry is None:
+                raise
+            logging.warning("Socrata backend not available ({e}), using response of dataset {d} cached at {t}".format(
+                e=e, d=dataset_identifier, t=datetime.datetime.fromtimestamp(entry['fetched_at']).isoformat()))
+            return pd.read_pickle(cache_path + '.pkl')
+        _save_cache_entry(cache_path=cache_path, results_df=results_df, entry={
+            'dataset': dataset_identifier,
+            'query': kwargs,
+            'fetched_at': time.time(),
+            'rows_updated_at': rows_updated_at
+        })
+        return results_df
+
+
+def _load_cache_entry(cache_path: str) -> dict:
+    if not os.path.exists(cache_path + '.json') or not os.path.exists(cache_path + '.pkl'):
+        return None
+    with open(cache_path + '.json') as f:
+        return json.load(f)
+
+
+def _save_cache_entry(cache_path: str, results_df: pd.DataFrame, entry: dict):
+    """ The response is written before its entry, so an entry always points to a complete response. """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    results_df.to_pickle(cache_path + '.pkl.tmp')
+    os.replace(cache_path + '.pkl.tmp', cache_path + '.pkl')
+    with open(cache_path + '.json.tmp', 'w') as f:
+        json.dump(entry, f, indent=2, default=str)
+    os.replace(cache_path + '.json.tmp', cache_path + '.json')
+
 
 def get_city_sensor_ids(arpa: ArpaConnect, city: str=None, prov: str=None) -> pd.DataFrame:
     """Get dataframe with sensor id, type and location """
@@ -55,89 +150,382 @@ def get_city_sensor_ids(arpa: ArpaConnect, city: str=None, prov: str=None) -> pd
     return reg_df
 
 
-def get_current_sensor_data(arpa: ArpaConnect, id_data: pd.DataFrame, dataset_identifier: str = None) -> pd.DataFrame:
-    """ Get dataframe with all sensor data for selected sensor id dataframe. """
+def _typed_page(page_df: pd.DataFrame) -> pd.DataFrame:
+    """ Type a page of measures as soon as it is downloaded, dropping missing values (-9999). """
+    if len(page_df) == 0:
+        return page_df
+    page_df = page_df.drop(columns='idoperatore', errors='ignore')
+    page_df['valore'] = pd.to_numeric(page_df['valore'], errors='coerce').astype(float)
+    page_df = page_df.loc[page_df['valore'] != -9999]
+    page_df = page_df.assign(data=pd.to_datetime(page_df['data']))
+    return page_df
+
+
+def _get_with_retries(arpa: ArpaConnect, dataset_identifier: str, **kwargs) -> pd.DataFrame:
+    for attempt in range(SOCRATA_RETRIES + 1):
+        try:
+            return arpa.get_df(dataset_identifier, **kwargs)
+        except Exception as e:
+            if attempt == SOCRATA_RETRIES:
+                raise
+            wait_seconds = SOCRATA_BACKOFF_SECONDS * 2 ** attempt
+            logging.warning("request failed ({e}), retrying in {w} seconds".format(e=e, w=wait_seconds))
+            time.sleep(wait_seconds)
+
+
+def _count_sensor_rows(arpa: ArpaConnect, dataset_identifier: str, where: str) -> int:
+    count_df = _get_with_retries(arpa, dataset_identifier, select='count(*) AS n', where=where)
+    return int(count_df['n'].iloc[0]) if len(count_df) > 0 else 0
+
+
+def _sensor_where(sensor: str, since: dict = None) -> str:
+    where = "idsensore = '{s}'".format(s=sensor)
+    if since is not None and sensor in since:
+        where += " AND data > '{d}'".format(d=since[sensor].strftime('%Y-%m-%dT%H:%M:%S'))
+    return where
+
+
+def get_current_sensor_data(arpa: ArpaConnect, id_data: pd.DataFrame, dataset_identifier: str = None,
+                            page_size: int = None, n_workers: int = None, since: dict = None) -> pd.DataFrame:
+    """
+    Get dataframe with all sensor data for selected sensor id dataframe.
+    The query is split by sensor and by offset in pages of page_size rows, downloaded by a pool of n_workers threads.
+    Each page is retried on its own and typed as soon as it arrives.
+    If since is given, for each sensor in it only measures after since[sensor] timestamp are downloaded.
+    """
     if dataset_identifier is None:
         dataset_identifier = ARPA_MEASURES_DATA_ID
-    where = "idsensore IN (" + str(id_data['idsensore'].to_list())[1:-1] + ")"
-    sensor_df = arpa.get_df(dataset_identifier=dataset_identifier, where=where, limit=6000000)
+    if page_size is None:
+        page_size = SOCRATA_PAGE_SIZE
+    if n_workers is None:
+        n_workers = SOCRATA_MAX_WORKERS
+    sensors = id_data['idsensore'].to_list()
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        wheres = {sensor: _sensor_where(sensor=sensor, since=since) for sensor in sensors}
+        counts = dict(zip(sensors, pool.map(lambda s: _count_sensor_rows(arpa, dataset_identifier, wheres[s]),
+                                            sensors)))
+        pages = [(sensor, offset) for sensor in sensors for offset in range(0, counts[sensor], page_size)]
+        logging.info("downloading {r} rows in {p} pages".format(r=sum(counts.values()), p=len(pages)))
+        futures = {page: pool.submit(_get_with_retries, arpa, dataset_identifier, where=wheres[page[0]],
+                                     order=':id', limit=page_size, offset=page[1])
+                   for page in pages}
+        typed_pages = {}
+        for page, future in futures.items():
+            typed_pages[page] = _typed_page(future.result())
+    if len(pages) == 0:
+        return pd.DataFrame()
+    sensor_df = pd.concat([typed_pages[page] for page in pages], ignore_index=True)
     return sensor_df
 
 
-def get_historical_sensor_data(id_data: pd.DataFrame) -> pd.DataFrame:
-    """ Load all data from previous years for selected sensor id dataframe. """
-    files = [file for file in os.listdir(ARPA_DATA_DIR) if file.endswith('.zip')]
-    hist_list = []
+def _parse_archive_dates(dates: pd.Series) -> pd.Series:
+    try:
+        return pd.to_datetime(dates, format=ARPA_CSV_DATE_FORMAT)
+    except ValueError:
+        logging.warning("dates do not match format {f}, inferring it".format(f=ARPA_CSV_DATE_FORMAT))
+        return pd.to_datetime(dates)
+
+
+def read_sensor_archive(path: str, id_data: pd.DataFrame, chunksize: int = None) -> pd.DataFrame:
+    """
+    Stream a yearly zipped csv in chunks of chunksize rows, keeping only rows of sensors in id_data without
+    missing values (-9999). Sensor type and station are mapped from id_data, so memory depends on selected sensors only.
+    """
+    if chunksize is None:
+        chunksize = ARPA_CSV_CHUNKSIZE
+    sensor_info = id_data.drop_duplicates('idsensore').set_index('idsensore')
+    header = pd.read_csv(path, compression='zip', nrows=0).columns
+    raw_cols = {c.lower(): c for c in header}
     csv_kwargs = {
         'compression': 'zip',
-        'parse_dates': ['Data'],
-        'dtype': {'IdSensore': str, 'valore': float}
+        'usecols': [c for c in header if c.lower() != 'idoperatore'],
+        'dtype': {raw_cols['idsensore']: str, raw_cols['valore']: float},
+        'chunksize': chunksize
     }
+    sensor_chunks = []
+    for chunk in pd.read_csv(path, **csv_kwargs):
+        chunk.columns = [c.lower() for c in chunk.columns]
+        chunk = chunk.loc[chunk['idsensore'].isin(sensor_info.index) & (chunk['valore'] != -9999)]
+        if len(chunk) == 0:
+            continue
+        chunk = chunk.assign(data=_parse_archive_dates(chunk['data']),
+                             nometiposensore=chunk['idsensore'].map(sensor_info['nometiposensore']),
+                             idstazione=chunk['idsensore'].map(sensor_info['idstazione']))
+        sensor_chunks.append(chunk)
+    if len(sensor_chunks) == 0:
+        # same dtypes as parsed chunks, so that callers can use the .dt accessor on an archive without selected sensors
+        empty_df = pd.DataFrame(columns=[c.lower() for c in csv_kwargs['usecols']] + ['nometiposensore', 'idstazione'])
+        return empty_df.astype({'idsensore': str, 'valore': float, 'data': 'datetime64[ns]'})
+    return pd.concat(sensor_chunks)
+
+
+def _archive_memory_mb(path: str) -> float:
+    """ Uncompressed size of a zipped archive, used as an upper bound of the memory needed to decode it. """
+    with zipfile.ZipFile(path) as archive:
+        return sum(info.file_size for info in archive.infolist()) / 2 ** 20
+
+
+def read_sensor_archives(paths: list, id_data: pd.DataFrame, n_workers: int = None,
+                         max_memory_mb: float = None) -> list:
+    """
+    Decode archives in paths across a pool of n_workers processes. A new archive is submitted only while the sum of
+    the uncompressed sizes of running archives stays within max_memory_mb (one archive at a time always runs).
+    Frames are returned in the same order as paths, whatever the order in which workers complete.
+    """
+    if n_workers is None:
+        n_workers = ARPA_HISTORY_WORKERS or os.cpu_count()
+    if max_memory_mb is None:
+        max_memory_mb = ARPA_HISTORY_MAX_MEMORY_MB
+    if n_workers == 1:
+        return [read_sensor_archive(path=path, id_data=id_data) for path in paths]
+    memory_mb = {path: _archive_memory_mb(path) for path in paths}
+    pending = list(paths)
+    running = {}
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        while pending or running:
+            while pending and len(running) < n_workers:
+                running_mb = sum(memory_mb[p] for p in running.values())
+                if len(running) > 0 and running_mb + memory_mb[pending[0]] > max_memory_mb:
+                    break
+                path = pending.pop(0)
+                logging.info("Loading sensor data {}".format(os.path.basename(path)))
+                running[pool.submit(read_sensor_archive, path, id_data)] = path
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return [results[path] for path in paths]
+
+
+def get_historical_sensor_data(id_data: pd.DataFrame, n_workers: int = None) -> pd.DataFrame:
+    """ Load all data from previous years for selected sensor id dataframe, decoding years in parallel. """
+    files = sorted(file for file in os.listdir(ARPA_DATA_DIR) if file.endswith('.zip'))
     id_data = id_data.loc[:, ["idsensore", "nometiposensore", "idstazione"]]
-    for f in files:
-        logging.info("Loading sensor data {}".format(f))
-        hist_single_df = pd.read_csv(os.path.join(ARPA_DATA_DIR, f), **csv_kwargs)
-        hist_single_df.columns = [c.lower() for c in hist_single_df.columns]
-        merged_single_df = pd.merge(hist_single_df, id_data, on='idsensore', how='inner')
-        merged_single_df = merged_single_df.loc[merged_single_df['valore'] != -9999]
-        merged_single_df = merged_single_df.drop(columns=['idoperatore'])
-        hist_list.append(merged_single_df)
-    hist_df = pd.concat(hist_list)
+    hist_list = read_sensor_archives(paths=[os.path.join(ARPA_DATA_DIR, f) for f in files], id_data=id_data,
+                                     n_workers=n_workers)
+    hist_df = apply_schema(pd.concat(hist_list), schema=ARPA_SCHEMA)
     return hist_df
 
 
-def load_historical_data(id_data: pd.DataFrame, build_historical: bool = False) -> pd.DataFrame:
+def shard_dir(id_data: pd.DataFrame) -> str:
+    """ Shards only contain selected sensors, so every selection of sensors has its own directory of shards. """
+    sensor_info = id_data.loc[:, ["idsensore", "nometiposensore", "idstazione"]].astype(str).sort_values('idsensore')
+    sensors_hash = hashlib.sha256(sensor_info.to_csv(index=False).encode()).hexdigest()
+    return os.path.join(ARPA_SHARD_DIR, sensors_hash[:16])
+
+
+def load_shard_manifest(shards_path: str) -> dict:
+    """ Manifest of history shards: for each zipped archive, its size, mtime, content hash, shard file and years. """
+    manifest_path = os.path.join(shards_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_shard_manifest(shards_path: str, manifest: dict):
+    manifest_path = os.path.join(shards_path, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _is_shard_current(entry: dict, path: str, shards_path: str) -> bool:
+    """ Check size and mtime of the archive first and fall back to its content hash only if they changed. """
+    if entry is None or not os.path.exists(os.path.join(shards_path, entry['shard'])):
+        return False
+    stat = os.stat(path)
+    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return True
+    if entry['size'] == stat.st_size and entry['sha256'] == file_sha256(path):
+        entry['mtime'] = stat.st_mtime_ns
+        return True
+    return False
+
+
+def build_history_shards(id_data: pd.DataFrame, n_workers: int = None) -> dict:
+    """
+    Convert each yearly zipped archive in ARPA_DATA_DIR to its own cached shard of selected sensors.
+    Only new or changed archives (size, mtime and content hash) are processed again.
+    """
+    shards_path = shard_dir(id_data=id_data)
+    os.makedirs(shards_path, exist_ok=True)
+    manifest = load_shard_manifest(shards_path=shards_path)
+    files = sorted(file for file in os.listdir(ARPA_DATA_DIR) if file.endswith('.zip'))
+    for removed in set(manifest) - set(files):
+        logging.info("Removing shard of deleted archive {}".format(removed))
+        shard_path = os.path.join(shards_path, manifest.pop(removed)['shard'])
+        if os.path.exists(shard_path):
+            os.remove(shard_path)
+    stale = [f for f in files if not _is_shard_current(manifest.get(f), os.path.join(ARPA_DATA_DIR, f), shards_path)]
+    logging.info("{n} of {t} archives to be converted to shards".format(n=len(stale), t=len(files)))
+    id_data = id_data.loc[:, ["idsensore", "nometiposensore", "idstazione"]]
+    frames = read_sensor_archives(paths=[os.path.join(ARPA_DATA_DIR, f) for f in stale], id_data=id_data,
+                                  n_workers=n_workers)
+    for f, frame in zip(stale, frames):
+        path = os.path.join(ARPA_DATA_DIR, f)
+        shard = os.path.splitext(f)[0] + '.pkl'
+        apply_schema(frame, schema=ARPA_SCHEMA).to_pickle(os.path.join(shards_path, shard))
+        stat = os.stat(path)
+        manifest[f] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha256': file_sha256(path),
+            'shard': shard,
+            'years': sorted(int(y) for y in frame['data'].dt.year.unique())
+        }
+    _save_shard_manifest(shards_path=shards_path, manifest=manifest)
+    return manifest
+
+
+def load_history_shards(id_data: pd.DataFrame, years: list = None) -> pd.DataFrame:
+    """ Assemble historical data from shards, reading only shards containing the requested years (all if None). """
+    shards_path = shard_dir(id_data=id_data)
+    manifest = load_shard_manifest(shards_path=shards_path)
+    shard_list = []
+    for f in sorted(manifest):
+        if years is not None and not set(manifest[f]['years']) & set(years):
+            continue
+        shard_df = pd.read_pickle(os.path.join(shards_path, manifest[f]['shard']))
+        if years is not None:
+            shard_df = shard_df.loc[shard_df['data'].dt.year.isin(years)]
+        shard_list.append(shard_df)
+    if len(shard_list) == 0:
+        raise RuntimeError("no history shard available for years {}".format(years))
+    return apply_schema(pd.concat(shard_list), schema=ARPA_SCHEMA)
+
+
+def load_historical_data(id_data: pd.DataFrame, build_historical: bool = False, n_workers: int = None,
+                         years: list = None) -> pd.DataFrame:
+    """
+    Load historical data of selected years (all if None) from per-archive shards. If build_historical, new or
+    changed archives are converted to shards first. Without shards, the legacy history_df.pkl is read.
+    """
     if build_historical:
-        logging.info("Create historical arpa dataframe from zipped csv")
-        hist_df = get_historical_sensor_data(id_data=id_data)
+        logging.info("Update historical arpa shards from zipped csv")
+        build_history_shards(id_data=id_data, n_workers=n_workers)
+    if len(load_shard_manifest(shards_path=shard_dir(id_data=id_data))) > 0:
+        logging.info("Create historical arpa dataframe from shards")
+        hist_df = load_history_shards(id_data=id_data, years=years)
     else:
         input_path = os.path.join(ARPA_DATA_DIR, 'history_df.pkl')
         logging.info("Create historical arpa dataframe from builded pickle")
         hist_df = pd.read_pickle(input_path)
+        if years is not None:
+            hist_df = hist_df.loc[hist_df['data'].dt.year.isin(years)]
     return hist_df
 
 
 def clean_current_sensor_df(sensor_df: pd.DataFrame, id_data: pd.DataFrame) -> pd.DataFrame:
-    """ Handle NA values, columns type, merge id info. """
-    cleaned_sensor_df = sensor_df.loc[sensor_df['valore'] != '-9999']
-    cleaned_sensor_df['valore'] = cleaned_sensor_df['valore'].astype(float)
-    cleaned_sensor_df['data'] = pd.to_datetime(cleaned_sensor_df.data)
-    cleaned_sensor_df = cleaned_sensor_df.drop(columns='idoperatore')
+    """ Merge id info. NA values and column types are already handled page by page at download time. """
     id_data = id_data.loc[:, ["idsensore", "nometiposensore", "idstazione"]]
-    merged_sensor_df = pd.merge(cleaned_sensor_df, id_data, on=['idsensore'])
+    merged_sensor_df = pd.merge(sensor_df, id_data, on=['idsensore'])
     return merged_sensor_df
 
 
-def get_all_sensor_data(arpa: ArpaConnect, station: str = None, build_historical: bool = False) -> pd.DataFrame:
+def get_all_sensor_data(arpa: ArpaConnect, station: str = None, build_historical: bool = False,
+                        n_workers: int = None, years: list = None) -> pd.DataFrame:
+    """
+    Historical and current data of the sensors of station, restricted to selected years (all if None): the current
+    year is downloaded via API only if selected, and only history shards containing previous selected years are read.
+    """
     id_data = get_city_sensor_ids(arpa=arpa, city=station)
-    current_sensor_df = get_current_sensor_data(arpa=arpa, id_data=id_data)
-    if len(current_sensor_df) == 0:
-        raise RuntimeError("no current data available for selected sensors")
-    current_df = clean_current_sensor_df(sensor_df=current_sensor_df, id_data=id_data)
-    historical_cleaned_df = load_historical_data(id_data=id_data, build_historical=build_historical)
-    all_sensor_df = pd.concat([historical_cleaned_df, current_df])
+    current_year = pd.Timestamp.now().year
+    data_list = []
+    if years is None or any(year < current_year for year in years):
+        hist_years = None if years is None else [year for year in years if year < current_year]
+        data_list.append(load_historical_data(id_data=id_data, build_historical=build_historical,
+                                              n_workers=n_workers, years=hist_years))
+    if years is None or current_year in years:
+        current_sensor_df = get_current_sensor_data(arpa=arpa, id_data=id_data)
+        if len(current_sensor_df) == 0:
+            raise RuntimeError("no current data available for selected sensors")
+        data_list.append(clean_current_sensor_df(sensor_df=current_sensor_df, id_data=id_data))
+    if len(data_list) == 0:
+        raise RuntimeError("no data available for years {}".format(years))
+    all_sensor_df = apply_schema(pd.concat(data_list), schema=ARPA_SCHEMA, log_report=True)
     return all_sensor_df
 
 
 def save_all_sensor_data(all_sensor_df, specific_file: str = None):
     if specific_file is None:
-        specific_file = 'arpa_data.pkl'
-    path_to_output = os.path.join(PROC_DATA_DIR, specific_file)
-    logging.info("saving arpa dataframe as pickle in {f}".format(f=specific_file))
-    all_sensor_df.to_pickle(path_to_output)
+        specific_file = 'arpa_data'
+    logging.info("saving arpa dataframe as {f}".format(f=specific_file))
+    all_sensor_df = apply_schema(all_sensor_df, schema=ARPA_SCHEMA)
+    save_frame(all_sensor_df, name=os.path.splitext(specific_file)[0])
+    save_watermarks(watermarks=_max_sensor_dates(all_sensor_df))
+
+
+def _max_sensor_dates(sensor_df: pd.DataFrame) -> dict:
+    max_dates = sensor_df.groupby(sensor_df['idsensore'].astype(str))['data'].max()
+    return max_dates.to_dict()
+
+
+def load_watermarks() -> dict:
+    """
+    Load the timestamp of the last measure stored for each sensor. If watermarks were never saved, they are derived
+    from the stored ARPA dataset; an empty dict is returned when neither exists.
+    """
+    if os.path.exists(ARPA_WATERMARK_PATH):
+        with open(ARPA_WATERMARK_PATH) as f:
+            return {sensor: pd.Timestamp(ts) for sensor, ts in json.load(f).items()}
+    if os.path.exists(dataset_path(name='arpa_data')):
+        logging.info("watermarks not found, deriving them from stored arpa data")
+        return _max_sensor_dates(load_frame(name='arpa_data', columns=['idsensore', 'data']))
+    return {}
+
+
+def save_watermarks(watermarks: dict):
+    os.makedirs(os.path.dirname(ARPA_WATERMARK_PATH), exist_ok=True)
+    with open(ARPA_WATERMARK_PATH + '.tmp', 'w') as f:
+        json.dump({sensor: ts.isoformat() for sensor, ts in sorted(watermarks.items())}, f, indent=2)
+    os.replace(ARPA_WATERMARK_PATH + '.tmp', ARPA_WATERMARK_PATH)
+
+
+def sync_sensor_data(arpa: ArpaConnect, station: str = None, watermarks: dict = None,
+                     overlap_hours: int = None) -> pd.DataFrame:
+    """
+    Download only the measures newer than the watermark of each sensor of station, going back overlap_hours to pick
+    up late corrections. Sensors without a watermark are downloaded for the whole current year.
+    """
+    if watermarks is None:
+        watermarks = load_watermarks()
+    if overlap_hours is None:
+        overlap_hours = ARPA_SYNC_OVERLAP_HOURS
+    id_data = get_city_sensor_ids(arpa=arpa, city=station)
+    overlap = pd.Timedelta(hours=overlap_hours)
+    since = {sensor: watermarks[sensor] - overlap for sensor in id_data['idsensore'] if sensor in watermarks}
+    new_sensor_df = get_current_sensor_data(arpa=arpa, id_data=id_data, since=since)
+    if len(new_sensor_df) == 0:
+        return new_sensor_df
+    return apply_schema(clean_current_sensor_df(sensor_df=new_sensor_df, id_data=id_data), schema=ARPA_SCHEMA)
+
+
+def upsert_sensor_data(new_sensor_df: pd.DataFrame, watermarks: dict, specific_file: str = None) -> int:
+    """
+    Upsert new measures into the stored ARPA dataset and move the watermarks forward. Measures already stored with the
+    same values, as those sent back by the overlap window of sync_sensor_data, are dropped first: if none is left,
+    neither the dataset nor the watermarks are written. Return the number of measures written.
+    """
+    if specific_file is None:
+        specific_file = 'arpa_data'
+    name = os.path.splitext(specific_file)[0]
+    new_sensor_df = drop_stored_rows(apply_schema(new_sensor_df, schema=ARPA_SCHEMA), name=name)
+    if len(new_sensor_df) == 0:
+        return 0
+    upsert_frame(new_sensor_df, name=name, keys=['idsensore', 'data'])
+    updated_watermarks = dict(watermarks)
+    for sensor, max_date in _max_sensor_dates(new_sensor_df).items():
+        updated_watermarks[sensor] = max(max_date, watermarks.get(sensor, max_date))
+    save_watermarks(watermarks=updated_watermarks)
+    return len(new_sensor_df)
 
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
     arpa = ArpaConnect()
-    logging.info("building ARPA {}".format("history_df.pkl"))
-    hist_arpa_list = []
     for station in ARPA_STATIONS:
         id_data = get_city_sensor_ids(arpa=arpa, city=station)
-        stat_hist_arpa_df = get_historical_sensor_data(id_data=id_data)
-        hist_arpa_list.append(stat_hist_arpa_df)
-    hist_arpa_df = pd.concat(hist_arpa_list)
-    out_hist_path = os.path.join(ARPA_DATA_DIR, 'history_df.pkl')
-    logging.info("saving to {}".format(out_hist_path))
-    hist_arpa_df.to_pickle(out_hist_path)
+        logging.info("building ARPA history shards for {s} in {p}".format(s=station, p=shard_dir(id_data=id_data)))
+        build_history_shards(id_data=id_data)
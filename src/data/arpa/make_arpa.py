@@ -9,8 +9,11 @@ import warnings
 sys.path.append(os.getcwd())
 warnings.filterwarnings('ignore')
 
-from src.data.arpa.arpa_quality_raw_funcs import ArpaConnect, get_all_sensor_data, save_all_sensor_data
+from src.data.arpa.arpa_quality_raw_funcs import ArpaConnect, get_all_sensor_data, save_all_sensor_data, \
+    load_watermarks, sync_sensor_data, upsert_sensor_data
+from src.data.storage import dataset_path
 from src.config import ARPA_STATIONS
+from src.instrumentation import record_rows
 
 
 def parse_args():
@@ -18,35 +21,80 @@ def parse_args():
     parser.add_argument("-b", "--build_history",
                         help="[False] historical data are read from zipped csv instead of prebuilt pickle",
                         required=False, default=False, action="store_true")
+    parser.add_argument("-w", "--workers",
+                        help="[None] number of processes decoding historical zipped csv, all cores if not set",
+                        required=False, default=None, type=int)
+    parser.add_argument("-i", "--incremental",
+                        help="[False] only measures newer than the last stored ones are downloaded and upserted",
+                        required=False, default=False, action="store_true")
+    parser.add_argument("-y", "--years", nargs='+', type=int,
+                        help="[all] only these years are rebuilt and upserted into stored data, if any",
+                        required=False, default=None)
     args = parser.parse_args()
-    return args.build_history
+    return args.build_history, args.workers, args.incremental, args.years
+
+
+def sync_arpa_dataset():
+    """
+    Incrementally update stored ARPA data: for each sensor only measures after its watermark (minus an overlap window
+    for late corrections) are downloaded, then upserted into the stored dataset.
+    """
+    arpa = ArpaConnect()
+    watermarks = load_watermarks()
+    new_data_list = []
+    for station in ARPA_STATIONS:
+        logging.info("Syncing ARPA data for station {s}".format(s=station))
+        station_sensor_df = sync_sensor_data(arpa=arpa, station=station, watermarks=watermarks)
+        logging.info("{n} new or corrected measures".format(n=len(station_sensor_df)))
+        new_data_list.append(station_sensor_df)
+    new_sensor_df = pd.concat(new_data_list)
+    record_rows(rows_in=len(new_sensor_df))
+    n_written = upsert_sensor_data(new_sensor_df=new_sensor_df, watermarks=watermarks) if len(new_sensor_df) > 0 else 0
+    record_rows(rows_out=n_written)
+    if n_written == 0:
+        logging.info("ARPA data already up to date")
 
 
-def make_arpa_dataset(build_historical: bool = False):
+def make_arpa_dataset(build_historical: bool = False, n_workers: int = None, incremental: bool = False,
+                      years: list = None):
     """
     Build sensor air quality data from ARPA open dataset, filtering for a selected city (parameter station below).
-    If -h is passed as argument to the script, historical data are read from zipped csv.
+    If -b is passed as argument to the script, historical data are read from zipped csv, decoding years in parallel
+    on n_workers processes.
     Historical data are downloaded as yearly zipped csv while current year data are obtained via API.
     Both kind of sources are publicly available at [this link](https://www.dati.lombardia.it/stories/s/auv9-c2sj)
+    If incremental is True and ARPA data were already built, only new measures are synced.
+    If years are given, only those years are built: historical shards of other years are not read, the current year
+    is downloaded only if selected, and measures are upserted into ARPA data already built instead of replacing them.
     """
+    is_stored = os.path.exists(dataset_path(name='arpa_data'))
+    if incremental and is_stored and years is None:
+        sync_arpa_dataset()
+        return
     arpa = ArpaConnect()
     all_data_list = []
     for station in ARPA_STATIONS:
         logging.info("Building ARPA data for station {s}".format(s=station))
         try:
-            station_sensor_df = get_all_sensor_data(arpa=arpa, station=station, build_historical=build_historical)
+            station_sensor_df = get_all_sensor_data(arpa=arpa, station=station, build_historical=build_historical,
+                                                    n_workers=n_workers, years=years)
         except RuntimeError as re:
             logging.exception(re)
             continue
         logging.info("max observation: {}".format(station_sensor_df['data'].max()))
         all_data_list.append(station_sensor_df)
     all_sensor_df = pd.concat(all_data_list)
+    if years is not None and is_stored:
+        n_written = upsert_sensor_data(new_sensor_df=all_sensor_df, watermarks=load_watermarks())
+        record_rows(rows_in=len(all_sensor_df), rows_out=n_written)
+        return
     save_all_sensor_data(all_sensor_df=all_sensor_df)
+    record_rows(rows_in=len(all_sensor_df), rows_out=len(all_sensor_df))
 
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
-    args = parse_args()
+    build_historical, n_workers, incremental, years = parse_args()
 
-    make_arpa_dataset(args)
+    make_arpa_dataset(build_historical=build_historical, n_workers=n_workers, incremental=incremental, years=years)
@@ -1,53 +1,88 @@
 # -*- coding: utf-8 -*-
 import os
-import logging
 import sys
 
 import pandas as pd
 
-from src.config import PROC_DATA_DIR
+from src.config import ARPA_SCHEMA, DATASET_SCHEMA, DATASET_FACT_COLS, WEATHER_SCHEMA
+from src.data.schema import apply_schema
+from src.data.storage import save_frame, load_frame
 
 sys.path.append(os.getcwd())
 
-from src.features.arpa_features import load_arpa_data, filter_by_frequency, aggregate_to_daily
+from src.features.arpa_features import load_arpa_data, filter_by_frequency, aggregate_by_period
+from src.features.date_dimension import build_date_dimension
 from src.features.weather_features import load_weather_data
+from src.instrumentation import record_rows
 
 
-def create_dataset(use_daily: bool = None) -> pd.DataFrame:
+def create_dataset(use_daily: bool = None, hourly: bool = False) -> tuple:
     """
-    Create a dataset with all ARPA air quality data with daily or hourly frequency depending on the argument.
-    Weather data are merged by timestamp, assuming that all ARPA data are from the same city of weather data.
+    Create the dataset as a star schema: a fact table with all ARPA air quality data with daily or hourly frequency
+    depending on the argument, and a date dimension with one row per date holding weather data and date-level
+    features. Measures without weather data for their date are dropped, assuming that all ARPA data are from the same
+    city of weather data.
+    If use_daily is False, every sensor, daily ones included, is averaged by day. If hourly is True, only sensors with
+    hourly frequency are kept instead, by hour (averaging duplicated measures), and the date dimension has a row per
+    hour.
     """
     if use_daily is None:
-        use_daily = True
+        use_daily = not hourly
     arpa_df = load_arpa_data()
     freq = 'daily' if use_daily else 'hourly'
     freq_arpa_df = filter_by_frequency(arpa_df=arpa_df, freq=freq)
-    if freq == 'hourly':
-        freq_arpa_df = aggregate_to_daily(arpa_df=arpa_df)
-    weather_df = load_weather_data()
-    dataset = pd.merge(freq_arpa_df, weather_df, on=['data'])
-    return dataset
+    if freq == 'hourly' and hourly:
+        freq_arpa_df = aggregate_by_period(arpa_df=freq_arpa_df, period='h')
+    elif freq == 'hourly':
+        freq_arpa_df = aggregate_by_period(arpa_df=arpa_df, period='D')
+    date_dimension = build_date_dimension(weather_df=load_weather_data(), hourly=hourly and freq == 'hourly')
+    facts = freq_arpa_df.loc[freq_arpa_df['data'].isin(date_dimension['data']), DATASET_FACT_COLS]
+    facts = apply_schema(facts, schema=ARPA_SCHEMA, log_report=True)
+    record_rows(rows_in=len(arpa_df), rows_out=len(facts))
+    return facts, date_dimension
 
 
-def save_dataset(dataset: pd.DataFrame):
-    """ Save the dataset as pickle """
-    out_path = os.path.join(PROC_DATA_DIR, 'dataset.pkl')
-    logging.info("saving dataset to {}".format(out_path))
-    dataset.to_pickle(out_path)
+def save_dataset(dataset: pd.DataFrame, date_dimension: pd.DataFrame = None):
+    """ Save the fact table and the date dimension of the dataset with the configured storage backend """
+    save_frame(dataset, name='dataset')
+    if date_dimension is not None:
+        save_frame(date_dimension, name='date_dimension')
 
 
-def load_dataset() -> pd.DataFrame:
-    in_path = os.path.join(PROC_DATA_DIR, 'dataset.pkl')
-    logging.info("loading dataset from {}".format(in_path))
-    dataset = pd.read_pickle(in_path)
-    return dataset
+def load_facts(columns: list = None, filters: list = None) -> pd.DataFrame:
+    """ Load the fact table of measures, optionally only some columns and the rows matching filters. """
+    facts = load_frame(name='dataset', columns=columns, filters=filters)
+    return facts
+
+
+def load_date_dimension(columns: list = None) -> pd.DataFrame:
+    """ Load the date dimension: weather data and date-level features, one row per date. """
+    date_dimension = load_frame(name='date_dimension', columns=columns)
+    return date_dimension
+
+
+def load_dataset(columns: list = None, filters: list = None) -> pd.DataFrame:
+    """
+    Load measures with their weather data, as a single table. Requested columns of the date dimension (weather data
+    if columns is None) are joined to the fact table by date; filters apply to the fact table (see load_frame).
+    """
+    if columns is None:
+        fact_cols, date_cols = None, list(WEATHER_SCHEMA)
+    else:
+        fact_cols = [c for c in columns if c in DATASET_FACT_COLS]
+        date_cols = [c for c in columns if c not in DATASET_FACT_COLS]
+        if len(date_cols) > 0 and 'data' not in fact_cols:
+            fact_cols.append('data')
+    dataset = load_facts(columns=fact_cols, filters=filters)
+    if len(date_cols) > 0:
+        date_dimension = load_date_dimension(columns=['data'] + date_cols)
+        dataset = apply_schema(pd.merge(dataset, date_dimension, on=['data']), schema=DATASET_SCHEMA)
+    return dataset[columns] if columns is not None else dataset
 
 
-def load_normalized_dataset() -> pd.DataFrame:
-    in_path = os.path.join(PROC_DATA_DIR, 'normalized_dataset.pkl')
-    logging.info("loading normalized dataset from {}".format(in_path))
-    dataset = pd.read_pickle(in_path)
+def load_normalized_dataset(columns: list = None, filters: list = None) -> pd.DataFrame:
+    """ Load the normalized dataset, optionally only some columns and the rows matching filters. """
+    dataset = load_frame(name='normalized_dataset', columns=columns, filters=filters)
     return dataset
 
 
@@ -16,23 +16,27 @@ def parse_args():
     parser.add_argument("-d", "--daily",
                         help="[False] daily data are considered instead of hourly",
                         required=False, default=False, action="store_true")
+    parser.add_argument("--hourly",
+                        help="[False] hourly data are kept by hour instead of being averaged by day",
+                        required=False, default=False, action="store_true")
     args = parser.parse_args()
-    return args.daily
+    return args.daily, args.hourly
 
 
-def make_dataset(use_daily: bool = None):
+def make_dataset(use_daily: bool = None, hourly: bool = False):
     """
-    Build total dataset merging ARPA air quality data with weather data.
-    If use_daily is passed as argument, only daily ARPA data are filtered, otherwise hourly data are selected.
+    Build total dataset from ARPA air quality data and weather data, as a fact table of measures and a date dimension.
+    If use_daily is passed as argument, only daily ARPA data are filtered, otherwise hourly data are selected and
+    averaged by day, or kept by hour if hourly is True.
     """
     logging.info('making final dataset from raw data')
-    dataset = create_dataset(use_daily=use_daily)
+    dataset, date_dimension = create_dataset(use_daily=use_daily, hourly=hourly)
     logging.info("max observation: {}".format(dataset['data'].max()))
-    save_dataset(dataset=dataset)
+    save_dataset(dataset=dataset, date_dimension=date_dimension)
 
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(funcName)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
-    daily = parse_args()
-    make_dataset(use_daily=daily)
+    daily, hourly = parse_args()
+    make_dataset(use_daily=daily, hourly=hourly)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pandas as pd
+
+NULLABLE_INT_DTYPES = ['Int8', 'Int16', 'Int32', 'Int64']
+
+
+def _cast_column(column: pd.Series, dtype: str) -> pd.Series:
+    if dtype in NULLABLE_INT_DTYPES:
+        numeric = pd.to_numeric(column, errors='coerce')
+        if numeric.isna().sum() > column.isna().sum():
+            logging.info("column {c} has non numeric values, casting to category instead of {d}".format(
+                c=column.name, d=dtype))
+            return column.astype('category')
+        return numeric.astype(dtype)
+    return column.astype(dtype)
+
+
+def apply_schema(df: pd.DataFrame, schema: dict, log_report: bool = False) -> pd.DataFrame:
+    """
+    Cast the columns of df listed in schema to their compact dtype; columns not in df are ignored.
+    If log_report is True, the memory used by each column before and after casting is logged.
+    """
+    cast_cols = {c: _cast_column(df[c], dtype) for c, dtype in schema.items()
+                 if c in df.columns and str(df[c].dtype) != dtype}
+    compact_df = df.assign(**cast_cols)
+    if log_report:
+        logging.info("memory report:\n{}".format(memory_report(before=df, after=compact_df).to_string()))
+    return compact_df
+
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame) -> pd.DataFrame:
+    """ Compare dtype and bytes used by each column of two versions of the same dataframe. """
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'bytes_before': before.memory_usage(index=False, deep=True),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_after': after.memory_usage(index=False, deep=True)
+    })
+    report.loc['total', ['bytes_before', 'bytes_after']] = report[['bytes_before', 'bytes_after']].sum()
+    report['saving_perc'] = (1 - report['bytes_after'] / report['bytes_before']) * 100
+    return report
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import operator
+import os
+import shutil
+
+import pandas as pd
+
+from src.config import PROC_DATA_DIR, STORAGE_BACKEND, STORAGE_PARTITIONS
+
+PARTITION_YEAR_COL = 'year'
+FILTER_OPERATORS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda column, values: column.isin(values),
+    'not in': lambda column, values: ~column.isin(values)
+}
+
+
+def dataset_path(name: str, backend: str = None, data_dir: str = None) -> str:
+    """ Path of a processed dataset: a pickle file or a directory of parquet files, depending on backend. """
+    if backend is None:
+        backend = STORAGE_BACKEND
+    if data_dir is None:
+        data_dir = PROC_DATA_DIR
+    extension = {'pickle': '.pkl', 'parquet': '.parquet'}[backend]
+    return os.path.join(data_dir, name + extension)
+
+
+def file_sha256(path: str) -> str:
+    """ Hash the content of a raw file, used to detect changed files when their size and mtime differ. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _remove_path(path: str):
+    """ Remove a dataset written as a single file or as a directory of partitions, if it exists. """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _with_partition_cols(df: pd.DataFrame, partition_cols: list, dt_col: str) -> pd.DataFrame:
+    if PARTITION_YEAR_COL in partition_cols and PARTITION_YEAR_COL not in df.columns:
+        df = df.assign(**{PARTITION_YEAR_COL: df[dt_col].dt.year})
+    return df
+
+
+def save_frame(df: pd.DataFrame, name: str, backend: str = None, data_dir: str = None, dt_col: str = 'data'):
+    """
+    Save a processed dataset. With parquet backend, files are partitioned by the columns listed for name in
+    STORAGE_PARTITIONS, where 'year' is derived from dt_col. The previous version is replaced only when the new one is
+    completely written.
+    """
+    if backend is None:
+        backend = STORAGE_BACKEND
+    out_path = dataset_path(name=name, backend=backend, data_dir=data_dir)
+    logging.info("saving {n} to {p}".format(n=name, p=out_path))
+    if backend == 'pickle':
+        df.to_pickle(out_path)
+        return
+    partition_cols = [c for c in STORAGE_PARTITIONS.get(name, []) if c == PARTITION_YEAR_COL or c in df.columns]
+    partitioned_df = _with_partition_cols(df=df, partition_cols=partition_cols, dt_col=dt_col)
+    tmp_path = out_path + '.tmp'
+    _remove_path(tmp_path)
+    partitioned_df.to_parquet(tmp_path, engine='pyarrow', index=False, partition_cols=partition_cols or None)
+    if os.path.exists(out_path):
+        _remove_path(out_path + '.old')
+        os.replace(out_path, out_path + '.old')
+        os.replace(tmp_path, out_path)
+        _remove_path(out_path + '.old')
+    else:
+        os.replace(tmp_path, out_path)
+
+
+def drop_stored_rows(df: pd.DataFrame, name: str, backend: str = None, data_dir: str = None,
+                     dt_col: str = 'data') -> pd.DataFrame:
+    """
+    Rows of df that are not already saved, with the same values, in dataset name. Only the 'year' partitions touched
+    by df are read. Rows are compared on all the columns of df, which must be columns of the dataset.
+    """
+    if len(df) == 0 or not os.path.exists(dataset_path(name=name, backend=backend, data_dir=data_dir)):
+        return df
+    years = sorted(df[dt_col].dt.year.unique().tolist())
+    saved_df = load_frame(name=name, columns=list(df.columns), filters=[(PARTITION_YEAR_COL, 'in', years)],
+                          backend=backend, data_dir=data_dir, dt_col=dt_col)
+    # values are compared as text so that dtypes and categories of the saved dataset do not matter
+    saved_hashes = pd.util.hash_pandas_object(saved_df.astype(str), index=False)
+    is_saved = pd.util.hash_pandas_object(df.astype(str), index=False).isin(saved_hashes).to_numpy()
+    return df.loc[~is_saved]
+
+
+def upsert_frame(df: pd.DataFrame, name: str, keys: list, backend: str = None, data_dir: str = None,
+                 dt_col: str = 'data'):
+    """
+    Insert the rows of df into a saved dataset, replacing saved rows with the same keys. With parquet backend only the
+    'year' partitions touched by df are read and rewritten. The dataset is created if it does not exist yet.
+    """
+    if backend is None:
+        backend = STORAGE_BACKEND
+    out_path = dataset_path(name=name, backend=backend, data_dir=data_dir)
+    if not os.path.exists(out_path):
+        save_frame(df, name=name, backend=backend, data_dir=data_dir, dt_col=dt_col)
+        return
+    partition_cols = STORAGE_PARTITIONS.get(name, [])
+    if backend == 'pickle' or PARTITION_YEAR_COL not in partition_cols:
+        saved_df = load_frame(name=name, backend=backend, data_dir=data_dir, dt_col=dt_col)
+        merged_df = pd.concat([saved_df, df]).drop_duplicates(subset=keys, keep='last')
+        save_frame(merged_df, name=name, backend=backend, data_dir=data_dir, dt_col=dt_col)
+        return
+    years = sorted(df[dt_col].dt.year.unique().tolist())
+    logging.info("upserting {r} rows into years {y} of {n}".format(r=len(df), y=years, n=name))
+    saved_df = load_frame(name=name, filters=[(PARTITION_YEAR_COL, 'in', years)], backend=backend, data_dir=data_dir,
+                          dt_col=dt_col)
+    merged_df = pd.concat([saved_df, df]).drop_duplicates(subset=keys, keep='last')
+    merged_df = merged_df.astype({c: 'category' for c in saved_df.select_dtypes('category').columns})
+    tmp_path = out_path + '.upsert'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    partition_cols = [c for c in partition_cols if c == PARTITION_YEAR_COL or c in merged_df.columns]
+    partitioned_df = _with_partition_cols(df=merged_df, partition_cols=partition_cols, dt_col=dt_col)
+    partitioned_df.to_parquet(tmp_path, engine='pyarrow', index=False, partition_cols=partition_cols)
+    for year in years:
+        partition = '{c}={y}'.format(c=PARTITION_YEAR_COL, y=year)
+        new_partition, old_partition = os.path.join(tmp_path, partition), os.path.join(out_path, partition)
+        if os.path.exists(old_partition):
+            shutil.rmtree(old_partition + '.old', ignore_errors=True)
+            os.replace(old_partition, old_partition + '.old')
+            os.replace(new_partition, old_partition)
+            shutil.rmtree(old_partition + '.old')
+        else:
+            os.replace(new_partition, old_partition)
+    shutil.rmtree(tmp_path)
+
+
+def _apply_filters(df: pd.DataFrame, filters: list, dt_col: str) -> pd.DataFrame:
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        if col == PARTITION_YEAR_COL and col not in df.columns:
+            column = df[dt_col].dt.year
+        else:
+            column = df[col]
+        mask &= FILTER_OPERATORS[op](column, value)
+    return df.loc[mask]
+
+
+def load_frame(name: str, columns: list = None, filters: list = None, backend: str = None, data_dir: str = None,
+               dt_col: str = 'data') -> pd.DataFrame:
+    """
+    Load a processed dataset, reading only the requested columns and the rows matching filters.
+    Filters are a list of (column, operator, value) tuples combined with AND, as in pyarrow: with parquet backend
+    they are pushed down to the files, so partitions by 'year' and sensor type are skipped without being read.
+    """
+    if backend is None:
+        backend = STORAGE_BACKEND
+    in_path = dataset_path(name=name, backend=backend, data_dir=data_dir)
+    logging.info("loading {n} from {p}".format(n=name, p=in_path))
+    if backend == 'pickle':
+        df = pd.read_pickle(in_path)
+        if filters:
+            df = _apply_filters(df=df, filters=filters, dt_col=dt_col)
+        return df[columns] if columns is not None else df
+    df = pd.read_parquet(in_path, engine='pyarrow', columns=columns, filters=filters or None)
+    if columns is None and PARTITION_YEAR_COL in STORAGE_PARTITIONS.get(name, []):
+        columns = [c for c in df.columns if c != PARTITION_YEAR_COL]
+    return df[columns] if columns is not None else df
@@ -5,28 +5,38 @@ import sys
 
 sys.path.append(os.getcwd())
 
-from src.data.weather.weather_raw_funcs import download_weather_data, create_weather_df, save_weather_df
+from src.data.weather.weather_raw_funcs import download_weather_data, update_weather_store
+from src.instrumentation import record_rows
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers",
+                        help="[None] number of processes parsing weather csv, all cores if not set",
+                        required=False, default=None, type=int)
+    parser.add_argument("-f", "--full_rebuild",
+                        help="[False] all weather csv are parsed again instead of new or changed ones only",
+                        required=False, default=False, action="store_true")
     args = parser.parse_args()
-    return args
+    return args.workers, args.full_rebuild
 
 
-def make_weather_dataset():
+def make_weather_dataset(n_workers: int = None, full_rebuild: bool = False):
     """
     Build weather data extracted from [this link](https://www.ilmeteo.it/portale/archivio-meteo/).
     Current month data are always downloaded, while previous month are downloaded only if absent from directory.
+    Only new or changed monthly csv (and the current month) are parsed, in parallel on n_workers processes, and
+    upserted into the processed weather data, unless full_rebuild is True.
     """
     download_weather_data()
-    weather_df = create_weather_df()
-    logging.info("max observation: {}".format(weather_df['data'].max()))
-    save_weather_df(weather_df=weather_df)
+    weather_df = update_weather_store(n_workers=n_workers, full_rebuild=full_rebuild)
+    record_rows(rows_in=len(weather_df), rows_out=len(weather_df))
+    if len(weather_df) > 0:
+        logging.info("max observation: {}".format(weather_df['data'].max()))
 
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
-    _ = parse_args()
-    make_weather_dataset()
+    n_workers, full_rebuild = parse_args()
+    make_weather_dataset(n_workers=n_workers, full_rebuild=full_rebuild)
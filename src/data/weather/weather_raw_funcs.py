@@ -1,41 +1,91 @@
 import datetime
+import io
+import json
 import logging
 import os
 import pandas as pd
 import requests
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 sys.path.append(os.getcwd())
 
-from src.config import WT_BASE_URL, ITA_MONTHS, WT_DATA_DIR, WT_STATIONS, WT_START_YEAR, PROC_DATA_DIR  # NOQA
+from src.config import WT_BASE_URL, ITA_MONTHS, WT_DATA_DIR, WT_STATIONS, WT_START_YEAR, \
+    WEATHER_SCHEMA, WT_CSV_ENCODING, WT_DOWNLOAD_WORKERS, WT_DOWNLOAD_RETRIES, WT_DOWNLOAD_BACKOFF_SECONDS, \
+    WT_DOWNLOAD_TIMEOUT, WT_CSV_DATE_FORMAT, WT_PARSE_WORKERS, WT_MANIFEST_PATH  # NOQA
+from src.data.schema import apply_schema  # NOQA
+from src.data.storage import save_frame, upsert_frame, dataset_path, file_sha256  # NOQA
 
 
-def download_weather_month(station: str = 'Milano', year: str = None, month: str = None):
+def weather_session(pool_size: int = None, retries: int = None, backoff: float = None) -> requests.Session:
+    """
+    Session shared by weather downloads: keeps up to pool_size connections open and retries failed requests with
+    exponential backoff.
+    """
+    if pool_size is None:
+        pool_size = WT_DOWNLOAD_WORKERS
+    if retries is None:
+        retries = WT_DOWNLOAD_RETRIES
+    if backoff is None:
+        backoff = WT_DOWNLOAD_BACKOFF_SECONDS
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504])
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_weather_month(station: str = 'Milano', year: str = None, month: str = None,
+                           session: requests.Session = None, base_url: str = None, data_dir: str = None):
     """
     Download csv file for selected station, year and month.
     Year and month are expected to be string such as '2020' and '03', respectively.
+    The body is streamed to a temporary file which is renamed only once completely downloaded, so that a failed
+    download never leaves a truncated csv behind.
     """
     if year is None:
         year = str(datetime.datetime.now().year)
     if month is None:
         month = str(datetime.datetime.now().strftime("%m"))
+    if session is None:
+        session = weather_session()
+    if base_url is None:
+        base_url = WT_BASE_URL
+    if data_dir is None:
+        data_dir = WT_DATA_DIR
     ita_month = ITA_MONTHS[month]
-    weather_url = WT_BASE_URL + "/".join([station, year, ita_month]) + "?format=csv"
-    weather_out_path = os.path.join(WT_DATA_DIR, 'weather_{}.csv'.format("_".join([station, year, ita_month])))
+    weather_url = base_url + "/".join([station, year, ita_month]) + "?format=csv"
+    weather_out_path = os.path.join(data_dir, 'weather_{}.csv'.format("_".join([station, year, ita_month])))
+    tmp_path = weather_out_path + '.part'
     logging.info("downloading data for {s} {y} {m} to {p}".format(s=station, y=year, m=ita_month, p=weather_out_path))
-    with open(weather_out_path, 'w') as f, requests.get(weather_url, stream=True) as r:
-        decoded = r.content.decode('ANSI')
-        f.write(decoded)
+    try:
+        with session.get(weather_url, stream=True, timeout=WT_DOWNLOAD_TIMEOUT) as r, open(tmp_path, 'wb') as f:
+            r.raise_for_status()
+            for block in r.iter_content(chunk_size=64 * 1024):
+                f.write(block)
+        os.replace(tmp_path, weather_out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _parse_file_name(file_name: str) -> tuple:
+    """
+    Extract station and year-month string from a file name such as weather_Milano_2020_Marzo.csv
+    """
+    station, year, ita_month = file_name[len('weather_'):-len('.csv')].rsplit("_", 2)
+    month = [k for k, v in ITA_MONTHS.items() if v == ita_month][0]
+    return station, year + "-" + month
 
 
 def _get_year_month(file_name):
     """
     Extract year and month from file name and concatenate to year-month string
     """
-    ym = file_name.replace('.csv', '')
-    year, ita_month = ym.split("_")[-2:]
-    month = [k for k, v in ITA_MONTHS.items() if v == ita_month][0]
-    return year + "-" + month
+    return _parse_file_name(file_name)[1]
 
 
 def get_params_list(start_year: str = None, stations_list: list = None) -> list:
@@ -49,11 +99,11 @@ def get_params_list(start_year: str = None, stations_list: list = None) -> list:
     files_to_download = []
     start_year_month = start_year + "-01"
     curr_year_month = str(datetime.datetime.now().strftime('%Y-%m'))
-    downloaded_files = os.listdir(WT_DATA_DIR)
-    downloaded_year_months = [_get_year_month(f) for f in downloaded_files if _get_year_month(f) != curr_year_month]
+    downloaded_files = [f for f in os.listdir(WT_DATA_DIR) if f.startswith('weather_') and f.endswith('.csv')]
+    downloaded_station_months = [_parse_file_name(f) for f in downloaded_files if _get_year_month(f) != curr_year_month]
     for station in stations_list:
         for ym in pd.date_range(start_year_month, curr_year_month, freq='MS'):
-            if ym.strftime('%Y-%m') not in downloaded_year_months:
+            if (station, ym.strftime('%Y-%m')) not in downloaded_station_months:
                 params_dict = {}
                 params_dict['station'] = station
                 params_dict['year'] = str(ym.year)
@@ -62,10 +112,27 @@ def get_params_list(start_year: str = None, stations_list: list = None) -> list:
     return files_to_download
 
 
-def download_weather_data():
+def download_weather_data(n_workers: int = None, base_url: str = None):
+    """
+    Download every missing month on n_workers threads sharing one session.
+    Failed months are logged and left missing, so that they are downloaded again by the next run.
+    """
+    if n_workers is None:
+        n_workers = WT_DOWNLOAD_WORKERS
     params_list = get_params_list()
-    for params_dict in params_list:
-        download_weather_month(**params_dict)
+    session = weather_session(pool_size=n_workers)
+    with session, ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(download_weather_month, session=session, base_url=base_url, **params_dict)
+                   for params_dict in params_list]
+        failed = []
+        for params_dict, future in zip(params_list, futures):
+            try:
+                future.result()
+            except requests.RequestException as e:
+                logging.error("download failed for {p}: {e}".format(p=params_dict, e=e))
+                failed.append(params_dict)
+    if len(failed) > 0:
+        logging.warning("{f} of {n} weather months not downloaded".format(f=len(failed), n=len(params_list)))
 
 
 def _clean_cols(c_name):
@@ -77,25 +144,144 @@ def _clean_cols(c_name):
     return cleaned
 
 
-def create_weather_df(data_dir: str = None) -> pd.DataFrame:
+def _parse_weather_csv(buffer: io.StringIO) -> pd.DataFrame:
+    """
+    Parse weather csv text. The header is read first to declare every measure column as float, so values are
+    converted by the csv reader itself; only if the text holds non numeric values, those columns are read as text and
+    coerced to NaN. Dates are parsed with the fixed WT_CSV_DATE_FORMAT.
+    """
+    read_params = {'sep': ';', 'decimal': ','}
+    raw_cols = pd.read_csv(io.StringIO(buffer.readline()), nrows=0, **read_params).columns
+    num_cols = [c for c in raw_cols if _clean_cols(c) not in ['localita', 'data', 'fenomeni']]
+    text_dtypes = {c: str for c in raw_cols if c not in num_cols}
+    buffer.seek(0)
+    try:
+        weather_df = pd.read_csv(buffer, dtype=dict(text_dtypes, **{c: 'float64' for c in num_cols}), **read_params)
+    except ValueError:
+        logging.info("non numeric weather values, coercing them to NaN")
+        buffer.seek(0)
+        weather_df = pd.read_csv(buffer, dtype=str, **read_params)
+        weather_df[num_cols] = weather_df[num_cols].apply(
+            lambda column: pd.to_numeric(column.str.replace(',', '.', regex=False), errors='coerce'))
+    weather_df.columns = [_clean_cols(c) for c in weather_df.columns]
+    weather_df['data'] = pd.to_datetime(weather_df['data'], format=WT_CSV_DATE_FORMAT)
+    return weather_df
+
+
+def read_weather_batch(paths: list) -> pd.DataFrame:
+    """
+    Parse a batch of monthly weather csv with a single call to the csv reader: files sharing the same header are
+    joined into one text before parsing, as each of them holds only a month of rows.
+    """
+    bodies = {}
+    for path in paths:
+        with open(path, encoding=WT_CSV_ENCODING) as f:
+            header = f.readline()
+            body = f.read()
+        if len(body) > 0 and not body.endswith('\n'):
+            body += '\n'
+        bodies.setdefault(header, []).append(body)
+    weather_list = [_parse_weather_csv(io.StringIO(header + ''.join(header_bodies)))
+                    for header, header_bodies in bodies.items()]
+    return pd.concat(weather_list, ignore_index=True)
+
+
+def read_weather_files(paths: list, n_workers: int = None) -> list:
+    """ Parse weather csv in paths as one batch per each of n_workers processes, returning frames in paths order. """
+    if n_workers is None:
+        n_workers = WT_PARSE_WORKERS or os.cpu_count()
+    n_batches = max(1, min(n_workers, len(paths)))
+    batches = [paths[i * len(paths) // n_batches:(i + 1) * len(paths) // n_batches] for i in range(n_batches)]
+    if n_batches == 1:
+        return [read_weather_batch(paths)]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(read_weather_batch, batches))
+
+
+def create_weather_df(data_dir: str = None, n_workers: int = None) -> pd.DataFrame:
     if data_dir is None:
         data_dir = WT_DATA_DIR
-    files = os.listdir(data_dir)
-    dt_parser = lambda date: datetime.datetime.strptime(date, '%d/%m/%Y')
-    weather_df = pd.concat(
-        [pd.read_csv(os.path.join(data_dir, f), sep=';', decimal=',', parse_dates=['DATA'], date_parser=dt_parser) for f in files])
-    weather_df.columns = [_clean_cols(c) for c in weather_df.columns]
-    w_cols = [c for c in weather_df.columns if c not in ['localita', 'data', 'fenomeni']]
-    weather_df.loc[:, w_cols] = weather_df.loc[:, w_cols].apply(pd.to_numeric, errors='coerce')
+    files = sorted(f for f in os.listdir(data_dir) if f.endswith('.csv'))
+    weather_list = read_weather_files(paths=[os.path.join(data_dir, f) for f in files], n_workers=n_workers)
+    weather_df = apply_schema(pd.concat(weather_list, ignore_index=True), schema=WEATHER_SCHEMA, log_report=True)
     return weather_df
 
 
 def save_weather_df(weather_df: pd.DataFrame, output_proc_file: str = None):
     if output_proc_file is None:
-        output_proc_file = 'weather_data.pkl'
-    path_to_output = os.path.join(PROC_DATA_DIR, output_proc_file)
-    logging.info("saving weather dataframe as pickle in {f}".format(f=output_proc_file))
-    weather_df.to_pickle(path_to_output)
+        output_proc_file = 'weather_data'
+    logging.info("saving weather dataframe as {f}".format(f=output_proc_file))
+    save_frame(weather_df, name=os.path.splitext(output_proc_file)[0])
+
+
+def load_weather_manifest() -> dict:
+    """ Manifest of the processed weather store: for each raw csv, its station, year-month, size, mtime and hash. """
+    if not os.path.exists(WT_MANIFEST_PATH):
+        return {}
+    with open(WT_MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def _save_weather_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(WT_MANIFEST_PATH), exist_ok=True)
+    with open(WT_MANIFEST_PATH + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(WT_MANIFEST_PATH + '.tmp', WT_MANIFEST_PATH)
+
+
+def _is_weather_file_current(entry: dict, path: str) -> bool:
+    """ Check size and mtime of the csv first and fall back to its content hash only if they changed. """
+    if entry is None:
+        return False
+    stat = os.stat(path)
+    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return True
+    if entry['size'] == stat.st_size and entry['sha256'] == file_sha256(path):
+        entry['mtime'] = stat.st_mtime_ns
+        return True
+    return False
+
+
+def update_weather_store(data_dir: str = None, n_workers: int = None, full_rebuild: bool = False) -> pd.DataFrame:
+    """
+    Keep the processed weather store in sync with raw csv, one (station, year-month) file at a time: only new or
+    changed files are parsed and upserted into the store by station and day. The current month, downloaded again at
+    each run, is parsed only if its content changed, so that the store is not rewritten when nothing is new.
+    The whole store is rebuilt if full_rebuild is True or if it was never built incrementally.
+    Return the parsed rows.
+    """
+    if data_dir is None:
+        data_dir = WT_DATA_DIR
+    files = sorted(f for f in os.listdir(data_dir) if f.endswith('.csv'))
+    manifest = load_weather_manifest()
+    if full_rebuild or not os.path.exists(dataset_path(name='weather_data')):
+        manifest = {}
+    for removed in set(manifest) - set(files):
+        logging.warning("{f} was removed, its rows are kept in the store until a full rebuild".format(f=removed))
+        manifest.pop(removed)
+    stale = [f for f in files if not _is_weather_file_current(manifest.get(f), os.path.join(data_dir, f))]
+    logging.info("{n} of {t} weather files to be parsed".format(n=len(stale), t=len(files)))
+    if len(stale) == 0:
+        return pd.DataFrame()
+    weather_list = read_weather_files(paths=[os.path.join(data_dir, f) for f in stale], n_workers=n_workers)
+    weather_df = apply_schema(pd.concat(weather_list, ignore_index=True), schema=WEATHER_SCHEMA, log_report=True)
+    if len(manifest) == 0:
+        save_weather_df(weather_df=weather_df)
+    else:
+        upsert_frame(weather_df, name='weather_data', keys=['localita', 'data'])
+    for f in stale:
+        path = os.path.join(data_dir, f)
+        stat = os.stat(path)
+        station, year_month = _parse_file_name(f)
+        manifest[f] = {
+            'station': station,
+            'year_month': year_month,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha256': file_sha256(path)
+        }
+    _save_weather_manifest(manifest=manifest)
+    return weather_df
 
 
 if __name__ == '__main__':
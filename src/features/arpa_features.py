@@ -2,17 +2,19 @@
 import os
 import logging
 import sys
+import numpy as np
 import pandas as pd
 
 sys.path.append(os.getcwd())
 
-from src.config import PROC_DATA_DIR, ARPA_MEASURES_FREQ
+from src.config import ARPA_MEASURES_FREQ
+from src.data.storage import load_frame
 
 
-def load_arpa_data() -> pd.DataFrame:
-    """ Load processed dataframe. """
+def load_arpa_data(columns: list = None, filters: list = None) -> pd.DataFrame:
+    """ Load processed dataframe, optionally only some columns and the rows matching filters. """
     logging.info("loading processed air quality ARPA data")
-    arpa_df = pd.read_pickle(os.path.join(PROC_DATA_DIR, 'arpa_data.pkl'))
+    arpa_df = load_frame(name='arpa_data', columns=columns, filters=filters)
     return arpa_df
 
 
@@ -25,13 +27,64 @@ def filter_by_frequency(arpa_df: pd.DataFrame, freq: str = None) -> pd.DataFrame
     return freq_arpa_df
 
 
+def _integer_codes(column: pd.Series) -> np.ndarray:
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy()
+    return pd.factorize(column)[0]
+
+
+def group_mean(keys: list, values: np.ndarray, valid: np.ndarray = None) -> tuple:
+    """
+    Mean of values grouped by integer keys, skipping NaN. Keys are combined into a single integer code, sorted once,
+    and contiguous runs of equal codes are reduced together.
+    :param keys: list of integer arrays of the same length as values
+    :param values: float array
+    :param valid: boolean array, if given the first row of each group is the first one where valid is True, as
+        pandas 'first' takes the first non-null value; groups without any valid row fall back to their first row
+    :return: a tuple (position of the first row of each group, mean of each group), groups ordered by keys
+    """
+    group_code = np.zeros(len(values), dtype=np.int64)
+    for key in keys:
+        key = key.astype(np.int64) - key.min()
+        group_code = group_code * (int(key.max()) + 1) + key
+    order = np.argsort(group_code)
+    sorted_code = group_code[order]
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = sorted_code[1:] != sorted_code[:-1]
+    starts = np.flatnonzero(is_start)
+    sorted_values = values[order].astype(np.float64)
+    not_na = ~np.isnan(sorted_values)
+    sums = np.add.reduceat(np.where(not_na, sorted_values, 0), starts)
+    counts = np.add.reduceat(not_na.astype(np.int64), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    first_rows = np.minimum.reduceat(order, starts)
+    if valid is not None:
+        first_valid = np.minimum.reduceat(np.where(valid[order], order, len(order)), starts)
+        first_rows = np.where(first_valid < len(order), first_valid, first_rows)
+    return first_rows, means
+
+
+def aggregate_by_period(arpa_df: pd.DataFrame, period: str = 'D') -> pd.DataFrame:
+    """
+    Average measures of each sensor over periods ('D' for days, 'h' for hours), keeping the first non-null stato of
+    each period. Sensor and period are grouped as integer keys; other sensor attributes, the same for every row of a
+    sensor, are taken from the row of that stato.
+    """
+    if len(arpa_df) == 0:
+        return arpa_df
+    periods = arpa_df['data'].to_numpy().astype('datetime64[{p}]'.format(p=period))
+    valid = arpa_df['stato'].notna().to_numpy() if 'stato' in arpa_df.columns else None
+    first_rows, means = group_mean(keys=[_integer_codes(arpa_df['idsensore']), periods.astype(np.int64)],
+                                   values=arpa_df['valore'].to_numpy(dtype=np.float64), valid=valid)
+    period_arpa_df = arpa_df.iloc[first_rows].reset_index(drop=True)
+    period_arpa_df['data'] = periods[first_rows].astype('datetime64[ns]')
+    period_arpa_df['valore'] = means.astype(arpa_df['valore'].dtype)
+    return period_arpa_df
+
+
 def aggregate_to_daily(arpa_df: pd.DataFrame) -> pd.DataFrame:
-    order_cols = list(arpa_df.columns)
-    hourly_arpa_df = arpa_df.rename({'data': 'data_ora'}, axis=1)
-    hourly_arpa_df['data'] = hourly_arpa_df['data_ora'].astype('<M8[D]')
-    daily_arpa_df = hourly_arpa_df.groupby(['idsensore', 'data', 'nometiposensore', 'idstazione']).agg(
-        {'valore': 'mean', 'stato': 'first'}).reset_index()
-    return daily_arpa_df[order_cols]
+    return aggregate_by_period(arpa_df=arpa_df, period='D')
 
 
 if __name__ == '__main__':
@@ -2,11 +2,15 @@ import logging
 import sys
 import pandas as pd
 
-from src.config import FEAT_KEEP_DTYPES
+from src.config import FEAT_KEEP_DTYPES, FEAT_HARMONIC_PERIODS, FEATURE_STORE_ENABLED
 from src.data.common_funcs import load_dataset
-from src.features.seasonality_features import add_harmonics
+from src.features.date_features import date_features
+from src.features.feature_store import FeatureStore
 from src.features.weather_features import create_weather_events
 
+# bump when features computed from the same input change, so that cached features are not reused
+FEATURES_VERSION = 3
+
 
 def build_dataset_with_sensor_dummies(dataset: pd.DataFrame) -> pd.DataFrame:
     dataset_with_dummies = pd.get_dummies(dataset, columns=['idsensore', 'nometiposensore', 'idstazione'],
@@ -15,24 +19,14 @@ def build_dataset_with_sensor_dummies(dataset: pd.DataFrame) -> pd.DataFrame:
 
 
 def build_calendar_features(dataset: pd.DataFrame) -> pd.DataFrame:
-    dataset_with_calendar = dataset.copy()
-    dataset_with_calendar['year'] = dataset_with_calendar['data'].dt.year
-    dataset_with_calendar['month_name'] = dataset_with_calendar['data'].dt.month_name()
-    dataset_with_calendar['day'] = dataset_with_calendar['data'].dt.day
-    dataset_with_calendar['day_of_week'] = dataset_with_calendar['data'].dt.strftime('%A')
-    dataset_with_calendar['weekofyear'] = dataset_with_calendar['data'].dt.weekofyear
-    dataset_with_calendar['dayofyear'] = dataset_with_calendar['data'].dt.dayofyear
-    dataset_with_calendar['date_unix'] = dataset_with_calendar['data'].astype('int64') / 1e09
-    dataset_with_calendar = pd.get_dummies(dataset_with_calendar, columns=['day_of_week', 'month_name'], prefix='',
-                                           prefix_sep='')
-    return dataset_with_calendar
+    calendar_df = date_features(dataset['data'], periods=[], index=dataset.index)
+    return pd.concat([dataset, calendar_df], axis=1)
 
 
 def build_date_features(dataset: pd.DataFrame) -> pd.DataFrame:
-    dataset_with_calendar = build_calendar_features(dataset=dataset)
-    dataset_with_harmonics = add_harmonics(dataset=dataset_with_calendar.set_index('data'),
-                                           periods=[(7, 3), (365.24, 3)]).reset_index()
-    return dataset_with_harmonics
+    """ Add calendar, month and weekday one-hot and harmonic features of column 'data', computed as a single block. """
+    date_df = date_features(dataset['data'], periods=FEAT_HARMONIC_PERIODS, index=dataset.index)
+    return pd.concat([dataset, date_df], axis=1)
 
 
 def select_numerical_columns(dataset: pd.DataFrame, dtypes_to_include: list = None) -> pd.DataFrame:
@@ -41,7 +35,27 @@ def select_numerical_columns(dataset: pd.DataFrame, dtypes_to_include: list = No
     return dataset.select_dtypes(include=dtypes_to_include)
 
 
-def build_dataset_features(dataset: pd.DataFrame, sensor_dummies: bool) -> pd.DataFrame:
+def join_date_features(facts: pd.DataFrame, date_dimension: pd.DataFrame) -> pd.DataFrame:
+    """
+    Numerical features of the measures in facts, indexed by date. Date-level features are not computed again but
+    joined from date_dimension, so the cost does not grow with the number of sensors sharing the same dates.
+    """
+    date_level_features = select_numerical_columns(dataset=date_dimension.set_index('data'))
+    fact_features = select_numerical_columns(dataset=facts.set_index('data'))
+    return fact_features.join(date_level_features, how='inner')
+
+
+def feature_config(sensor_dummies: bool) -> dict:
+    """ Every setting that changes the features computed from the same dataset. """
+    return {
+        'version': FEATURES_VERSION,
+        'sensor_dummies': sensor_dummies,
+        'harmonic_periods': FEAT_HARMONIC_PERIODS,
+        'keep_dtypes': FEAT_KEEP_DTYPES
+    }
+
+
+def compute_dataset_features(dataset: pd.DataFrame, sensor_dummies: bool) -> pd.DataFrame:
     if sensor_dummies:
         dataset = build_dataset_with_sensor_dummies(dataset=dataset)
     dataset_with_weather_events = create_weather_events(weather_df=dataset)
@@ -51,6 +65,24 @@ def build_dataset_features(dataset: pd.DataFrame, sensor_dummies: bool) -> pd.Da
     return dataset_with_int_cols
 
 
+def build_dataset_features(dataset: pd.DataFrame, sensor_dummies: bool, store: FeatureStore = None) -> pd.DataFrame:
+    """
+    Numerical features of dataset, indexed by date. Features are read from store if the same dataset was already
+    featurized with the same configuration, otherwise computed and saved to store.
+    If store is None, the default FeatureStore is used unless FEATURE_STORE_ENABLED is False.
+    """
+    if store is None and FEATURE_STORE_ENABLED:
+        store = FeatureStore()
+    if store is None:
+        return compute_dataset_features(dataset=dataset, sensor_dummies=sensor_dummies)
+    key = store.key(dataset=dataset, config=feature_config(sensor_dummies=sensor_dummies))
+    dataset_with_features = store.get(key)
+    if dataset_with_features is None:
+        dataset_with_features = compute_dataset_features(dataset=dataset, sensor_dummies=sensor_dummies)
+        store.put(key, dataset_with_features)
+    return dataset_with_features
+
+
 if __name__ == '__main__':
     dataset = load_dataset()
     sensor_dummies = True if len(sys.argv) > 1 and sys.argv[1] == '-all' else False
@@ -0,0 +1,36 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from src.config import WEATHER_SCHEMA, FEAT_HARMONIC_PERIODS, FEAT_HOUR_HARMONIC_PERIODS
+from src.data.schema import apply_schema
+from src.features.date_features import date_features
+from src.features.weather_features import create_weather_events
+
+
+def _expand_to_hours(date_dimension: pd.DataFrame) -> pd.DataFrame:
+    """ Repeat each daily row for the 24 hours of its day. """
+    hourly_dimension = date_dimension.iloc[np.repeat(np.arange(len(date_dimension)), 24)].reset_index(drop=True)
+    hours = np.tile(np.arange(24), len(date_dimension)).astype('timedelta64[h]')
+    hourly_dimension['data'] = hourly_dimension['data'].to_numpy() + hours
+    return hourly_dimension
+
+
+def build_date_dimension(weather_df: pd.DataFrame, hourly: bool = False) -> pd.DataFrame:
+    """
+    Date dimension of the dataset: one row per date with weather data, weather events, calendar and harmonic
+    features, computed once for all sensors. Weather data are assumed to come from a single city.
+    If hourly, there is a row per hour, holding the weather data of its day, the hour of day and its harmonics.
+    """
+    date_dimension = weather_df.drop_duplicates(subset='data').sort_values('data').reset_index(drop=True)
+    if len(date_dimension) < len(weather_df):
+        logging.warning("weather data hold more than one row per date, keeping the first one")
+    date_dimension = apply_schema(date_dimension, schema=WEATHER_SCHEMA)
+    date_dimension = create_weather_events(weather_df=date_dimension)
+    periods = FEAT_HARMONIC_PERIODS
+    if hourly:
+        date_dimension = _expand_to_hours(date_dimension=date_dimension)
+        periods = FEAT_HARMONIC_PERIODS + FEAT_HOUR_HARMONIC_PERIODS
+    date_df = date_features(date_dimension['data'], periods=periods, index=date_dimension.index, with_hour=hourly)
+    return pd.concat([date_dimension, date_df], axis=1)
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from src.config import FEAT_CAL_COLS, FEAT_MONTH_COLS, FEAT_WEEK_COLS, FEAT_HARMONIC_PERIODS
+from src.features.seasonality_features import harmonic_block, harmonic_columns
+
+CALENDAR_COLS = FEAT_CAL_COLS + ['date_unix']
+
+
+def date_feature_columns(periods=None, with_hour: bool = False) -> list:
+    """
+    Fixed order of date features: calendar integers, date_unix, hour of day if with_hour, a column for each month and
+    weekday (whether present in data or not), then sin and cos harmonics of periods.
+    """
+    if periods is None:
+        periods = FEAT_HARMONIC_PERIODS
+    return _calendar_cols(with_hour) + FEAT_MONTH_COLS + FEAT_WEEK_COLS + harmonic_columns(periods)
+
+
+def _calendar_cols(with_hour: bool) -> list:
+    return CALENDAR_COLS + ['hour'] if with_hour else CALENDAR_COLS
+
+
+def _calendar_fields(dates) -> dict:
+    """ Year, month, day, ISO week, day of year and weekday (Monday=0) of dates, computed on datetime64 arrays. """
+    values = pd.DatetimeIndex(dates).values
+    days = values.astype('datetime64[D]')
+    months = values.astype('datetime64[M]')
+    years = values.astype('datetime64[Y]')
+    weekday = (days.astype(np.int64) + 3) % 7
+    iso_thursday = days - weekday + 3
+    iso_year_start = iso_thursday.astype('datetime64[Y]').astype('datetime64[D]')
+    return {
+        'year': years.astype(np.int64) + 1970,
+        'month': months.astype(np.int64) % 12 + 1,
+        'day': (days - months.astype('datetime64[D]')).astype(np.int64) + 1,
+        'weekofyear': (iso_thursday - iso_year_start).astype(np.int64) // 7 + 1,
+        'dayofyear': (days - years.astype('datetime64[D]')).astype(np.int64) + 1,
+        'weekday': weekday,
+        'hour': (values.astype('datetime64[h]') - days).astype(np.int64),
+        'date_unix': values.astype(np.int64) / 1e09
+    }
+
+
+def date_feature_block(dates, periods=None, with_hour: bool = False) -> np.ndarray:
+    """
+    Compute every date feature of dates into one preallocated float32 array, columns as
+    date_feature_columns(periods, with_hour). The date_unix column is left to 0: float32 cannot hold seconds since
+    epoch (steps of 128 s), so date_features adds it as float64.
+    """
+    if periods is None:
+        periods = FEAT_HARMONIC_PERIODS
+    fields = _calendar_fields(dates)
+    n_rows = len(fields['date_unix'])
+    calendar_cols = _calendar_cols(with_hour)
+    n_cal, n_month, n_week = len(calendar_cols), len(FEAT_MONTH_COLS), len(FEAT_WEEK_COLS)
+    block = np.zeros((n_rows, len(date_feature_columns(periods, with_hour))), dtype=np.float32)
+    for i, col in enumerate(calendar_cols):
+        if col != 'date_unix':
+            block[:, i] = fields[col]
+    rows = np.arange(n_rows)
+    block[rows, n_cal + fields['month'] - 1] = 1
+    # FEAT_WEEK_COLS starts from Sunday
+    block[rows, n_cal + n_month + (fields['weekday'] + 1) % 7] = 1
+    harmonic_block(dates, periods, out=block[:, n_cal + n_month + n_week:])
+    return block
+
+
+def date_features(dates, periods=None, index=None, with_hour: bool = False) -> pd.DataFrame:
+    """ Date features of dates as a dataframe with columns date_feature_columns(periods, with_hour). """
+    date_df = pd.DataFrame(date_feature_block(dates, periods=periods, with_hour=with_hour),
+                           columns=date_feature_columns(periods, with_hour), index=index)
+    date_df['date_unix'] = pd.DatetimeIndex(dates).values.astype(np.int64) / 1e09
+    return date_df
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import logging
+import os
+
+import pandas as pd
+
+from src.config import FEATURE_STORE_DIR, FEATURE_STORE_MAX_MB
+
+
+class FeatureStore:
+    """
+    On-disk cache of feature matrices, keyed by a hash of the input frame and of the feature configuration, so that
+    identical inputs are featurized only once across runs and processes.
+    When the files in store_dir exceed max_size_mb, the least recently used ones are deleted first.
+    """
+
+    def __init__(self, store_dir: str = None, max_size_mb: float = None):
+        if store_dir is None:
+            store_dir = FEATURE_STORE_DIR
+        if max_size_mb is None:
+            max_size_mb = FEATURE_STORE_MAX_MB
+        self.store_dir = store_dir
+        self.max_size_mb = max_size_mb
+
+    @staticmethod
+    def key(dataset: pd.DataFrame, config: dict) -> str:
+        """ Hash content, column names and dtypes of dataset, in its row order, together with config. """
+        digest = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode())
+        digest.update(str(list(zip(dataset.columns, dataset.dtypes.astype(str)))).encode())
+        digest.update(pd.util.hash_pandas_object(dataset, index=True).values.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.store_dir, 'features_{}.pkl'.format(key))
+
+    def get(self, key: str) -> pd.DataFrame:
+        """ Return the features saved for key, None if missing. """
+        path = self._path(key)
+        try:
+            features = pd.read_pickle(path)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        logging.info("features found in store ({k})".format(k=key[:12]))
+        return features
+
+    def put(self, key: str, features: pd.DataFrame):
+        os.makedirs(self.store_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = '{p}.{pid}.tmp'.format(p=path, pid=os.getpid())
+        features.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        self.evict(keep=key)
+
+    def evict(self, keep: str = None):
+        """ Delete least recently used feature files, except the one of key keep, until the store fits max_size_mb. """
+        entries = []
+        for f in os.listdir(self.store_dir):
+            if f.startswith('features_') and f.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.store_dir, f))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, f))
+        total_size = sum(size for _, size, _ in entries)
+        kept_file = os.path.basename(self._path(keep)) if keep is not None else None
+        for _, size, f in sorted(entries):
+            if total_size <= self.max_size_mb * 2 ** 20:
+                break
+            if f == kept_file:
+                continue
+            logging.debug("evicting {f} from feature store".format(f=f))
+            try:
+                os.remove(os.path.join(self.store_dir, f))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        for f in os.listdir(self.store_dir) if os.path.isdir(self.store_dir) else []:
+            if f.startswith('features_'):
+                os.remove(os.path.join(self.store_dir, f))
@@ -4,6 +4,33 @@ import numpy as np
 import pandas as pd
 
 
+def harmonic_columns(periods) -> list:
+    """ Names of the harmonics columns for periods, in the order of harmonic_block. """
+    return [f'{wave}_{round(period)}_{i}' for period, n in periods for i in range(1, n + 1) for wave in ['Sin', 'Cos']]
+
+
+def harmonic_block(dates, periods, out: np.ndarray = None, epoch=datetime(1900, 1, 1)) -> np.ndarray:
+    """
+    Computes harmonics for all periods at once, broadcasting the hours from epoch against the frequencies i/period.
+    :param dates: a pandas series or index of dates
+    :param periods: list-like object of tuples (period, number_of_harmonics)
+    :param out: optional float array with a column for each of harmonic_columns(periods), filled in place
+    :param epoch: the epoch used to compute the argument of the sin
+    :return: array with a row for each date and columns as harmonic_columns(periods)
+    """
+    hours = ((pd.DatetimeIndex(dates) - epoch) / pd.Timedelta(hours=1)).values
+    n_cols = 2 * sum(n for _, n in periods)
+    if out is None:
+        out = np.empty((len(hours), n_cols), dtype=np.float32)
+    col = 0
+    for period, n in periods:
+        angles = np.multiply.outer(2 * np.pi * hours / period, np.arange(1, n + 1))
+        out[:, col:col + 2 * n:2] = np.sin(angles)
+        out[:, col + 1:col + 2 * n:2] = np.cos(angles)
+        col += 2 * n
+    return out
+
+
 def harmonics(dates, period, n, epoch=datetime(1900, 1, 1)):
     """
     Computes harmonics for the given dates. Each harmonic is made of a couple of sinusoidal and cosinusoidal waves
@@ -14,19 +41,8 @@ def harmonics(dates, period, n, epoch=datetime(1900, 1, 1)):
     :param epoch: the epoch used to compute the argument of the sin
     :return: a pandas dataframe with dates as index and harmonics as columns
     """
-    d = pd.DataFrame(index=dates)
-    hours = (dates - epoch) / pd.Timedelta(hours=1)
-
-    for i in range(1, n + 1):
-        d[f'Sin_{round(period)}_{i}'] = np.sin(2 * i * np.pi * hours / period)
-        d[f'Cos_{round(period)}_{i}'] = np.cos(2 * i * np.pi * hours / period)
-
-    return d
-
-
-def _add_harmonics(df: pd.DataFrame, period, n):
-    harm = harmonics(df.index, period, n)
-    return pd.concat([df, harm], axis=1)
+    block = harmonic_block(dates, [(period, n)], out=np.empty((len(dates), 2 * n)), epoch=epoch)
+    return pd.DataFrame(block, index=dates, columns=harmonic_columns([(period, n)]))
 
 
 def add_harmonics(dataset: pd.DataFrame, periods):
@@ -39,10 +55,6 @@ def add_harmonics(dataset: pd.DataFrame, periods):
     :param periods: list-like object of integer-valued tuples (period, number_of_harmonics)
     :return: the given dataframe with harmonics as additional columns
     """
-    d = dataset.copy()
-
-    for period, n in periods:
-        d = _add_harmonics(d, period, n)
-
-    return d
-
+    block = harmonic_block(dataset.index, periods, out=np.empty((len(dataset), 2 * sum(n for _, n in periods))))
+    harm = pd.DataFrame(block, index=dataset.index, columns=harmonic_columns(periods))
+    return pd.concat([dataset, harm], axis=1)
@@ -6,12 +6,12 @@ import pandas as pd
 
 sys.path.append(os.getcwd())
 
-from src.config import PROC_DATA_DIR
+from src.data.storage import load_frame
 
 
-def load_weather_data() -> pd.DataFrame:
-    """ Load processed weather data. """
-    weather_df = pd.read_pickle(os.path.join(PROC_DATA_DIR, 'weather_data.pkl'))
+def load_weather_data(columns: list = None, filters: list = None) -> pd.DataFrame:
+    """ Load processed weather data, optionally only some columns and the rows matching filters. """
+    weather_df = load_frame(name='weather_data', columns=columns, filters=filters)
     return weather_df
 
 
@@ -0,0 +1,263 @@
+import cProfile
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from src.config import RUN_REPORT_DIR, PROFILE_ENV_VAR, PROFILE_TOP_N
+
+# stages being measured by each thread, innermost last; record_rows and record_item update the innermost one of the
+# calling thread, so that stages running concurrently in threads do not mix their rows
+_thread_state = threading.local()
+# blocks being measured in this process, whose peak RSS must survive the reset done by nested blocks
+_active_measures = []
+
+
+def _active_stages() -> list:
+    if not hasattr(_thread_state, 'stages'):
+        _thread_state.stages = []
+    return _thread_state.stages
+
+
+def _reset_peak_rss() -> bool:
+    """ Reset the peak resident set size of this process (Linux only), so that it can be measured per block. """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float:
+    """ Peak resident set size of this process, since the last reset where supported, since start otherwise. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def _children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Measure:
+    """
+    Wall time, CPU time and peak RSS of a block of code. CPU time of the block is the time of the calling thread if
+    thread_cpu is True, so that blocks running concurrently in a thread pool are told apart; otherwise it is the time
+    of the whole process plus the time of child processes that terminated during the block.
+    Peak RSS is the one of the whole process while the block runs; it does not include child processes. Both are
+    shared by blocks running concurrently in threads of the same process.
+    """
+
+    def __init__(self, thread_cpu: bool = False):
+        self.thread_cpu = thread_cpu
+        self.metrics = {}
+        self._observed_peak_mb = 0.
+
+    def _cpu_seconds(self) -> float:
+        if self.thread_cpu:
+            return time.thread_time()
+        return time.process_time() + _children_cpu_seconds()
+
+    def __enter__(self):
+        current_peak_mb = peak_rss_mb()
+        for active in _active_measures:
+            active._observed_peak_mb = max(active._observed_peak_mb, current_peak_mb)
+        self._peak_reset = _reset_peak_rss()
+        _active_measures.append(self)
+        self._start_wall = time.perf_counter()
+        self._start_cpu = self._cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_measures.remove(self)
+        self.metrics.update({
+            'wall_seconds': time.perf_counter() - self._start_wall,
+            'cpu_seconds': self._cpu_seconds() - self._start_cpu,
+            'peak_rss_mb': max(self._observed_peak_mb, peak_rss_mb()),
+            'peak_rss_scope': 'block' if self._peak_reset else 'process'
+        })
+        return False
+
+
+def call_measured(func, *args) -> tuple:
+    """
+    Call func(*args) and return its result with its measures, rows out being the length of the result.
+    Defined at module level so that it can be sent to a process pool, where it measures the worker.
+    """
+    with Measure(thread_cpu=True) as measure:
+        result = func(*args)
+    if hasattr(result, '__len__'):
+        measure.metrics['rows_out'] = len(result)
+    return result, measure.metrics
+
+
+def record_rows(rows_in: int = None, rows_out: int = None):
+    """ Record rows read and written by the stage being measured, if any. """
+    if len(_active_stages()) == 0:
+        return
+    if rows_in is not None:
+        _active_stages()[-1]['rows_in'] = int(rows_in)
+    if rows_out is not None:
+        _active_stages()[-1]['rows_out'] = int(rows_out)
+
+
+def record_item(item: str, metrics: dict, rows_in: int = None):
+    """ Record the measures of an item processed by the stage being measured, e.g. a sensor, if any. """
+    if len(_active_stages()) == 0:
+        return
+    item_metrics = dict(metrics)
+    if rows_in is not None:
+        item_metrics['rows_in'] = int(rows_in)
+    _active_stages()[-1].setdefault('items', {})[str(item)] = item_metrics
+
+
+def profile_request(env: dict = None) -> tuple:
+    """
+    Parse the profiling switch PROFILE_ENV_VAR, such as 'normalize' or 'normalize:tracemalloc': the stage to profile
+    and the profiler, cprofile by default. (None, None) if profiling is off.
+    """
+    if env is None:
+        env = os.environ
+    value = env.get(PROFILE_ENV_VAR, '').strip()
+    if len(value) == 0:
+        return None, None
+    stage, _, profiler = value.partition(':')
+    profiler = profiler or 'cprofile'
+    if profiler not in ('cprofile', 'tracemalloc'):
+        raise ValueError("{v}: profiler must be cprofile or tracemalloc, not {p}".format(
+            v=PROFILE_ENV_VAR, p=profiler))
+    return stage, profiler
+
+
+class RunReport:
+    """
+    Report of a pipeline run: wall time, CPU time, peak RSS and rows in/out of every stage, and of every item (e.g.
+    sensor) of a stage, saved as json in report_dir when the run ends, whether it succeeds or fails.
+    A stage named in the PROFILE_ENV_VAR environment variable is also profiled with cProfile, whose stats are saved
+    next to the report, or with tracemalloc, whose top allocations are added to the report.
+    """
+
+    def __init__(self, name: str, params: dict = None, report_dir: str = None):
+        if report_dir is None:
+            report_dir = RUN_REPORT_DIR
+        self.name = name
+        self.report_dir = report_dir
+        self.started_at = datetime.datetime.now()
+        self.run_id = '{n}_{t}_{p}'.format(n=name, t=self.started_at.strftime('%Y%m%d_%H%M%S'), p=os.getpid())
+        self.profile_stage, self.profiler = profile_request()
+        self.report = {
+            'run_id': self.run_id,
+            'name': name,
+            'params': params or {},
+            'started_at': self.started_at.isoformat(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'pid': os.getpid(),
+            'status': 'running',
+            'stages': []
+        }
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.report_dir, self.run_id + '.json')
+
+    def __enter__(self):
+        self._measure = Measure().__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._measure.__exit__(exc_type, exc_value, traceback)
+        self.report.update(self._measure.metrics)
+        self.report.update({
+            'finished_at': datetime.datetime.now().isoformat(),
+            'status': 'failed' if exc_type is not None else 'succeeded'
+        })
+        if exc_type is not None:
+            self.report['error'] = repr(exc_value)
+        self.save()
+        return False
+
+    @contextmanager
+    def stage(self, name: str):
+        """ Measure the block as stage name; rows and items are recorded from inside with record_rows/record_item. """
+        stage = {'name': name, 'status': 'running'}
+        self.report['stages'].append(stage)
+        _active_stages().append(stage)
+        profiler = self.profiler if name == self.profile_stage else None
+        logging.info("starting stage {s}{p}".format(s=name, p=" with " + profiler if profiler else ""))
+        try:
+            with Measure() as measure, self._profiled(stage=stage, profiler=profiler):
+                yield stage
+            stage['status'] = 'succeeded'
+        except Exception as e:
+            stage.update({'status': 'failed', 'error': repr(e)})
+            raise
+        finally:
+            _active_stages().remove(stage)
+            stage.update(measure.metrics)
+            logging.info("stage {s} {st} in {w:.1f} s (cpu {c:.1f} s), peak rss {m:.0f} MB".format(
+                s=name, st=stage['status'], w=stage['wall_seconds'], c=stage['cpu_seconds'], m=stage['peak_rss_mb']))
+
+    @contextmanager
+    def _profiled(self, stage: dict, profiler: str = None):
+        if profiler == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                os.makedirs(self.report_dir, exist_ok=True)
+                stats_path = os.path.join(self.report_dir, '{r}_{s}.prof'.format(r=self.run_id, s=stage['name']))
+                profile.dump_stats(stats_path)
+                stats_text = io.StringIO()
+                pstats.Stats(profile, stream=stats_text).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+                logging.info("profile of stage {s} saved to {p}\n{t}".format(
+                    s=stage['name'], p=stats_path, t=stats_text.getvalue()))
+                stage['profile'] = stats_path
+        elif profiler == 'tracemalloc':
+            tracemalloc.start()
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                stage['tracemalloc'] = {
+                    'peak_mb': peak_bytes / 2 ** 20,
+                    'top_allocations': [{'line': str(stat.traceback), 'size_mb': stat.size / 2 ** 20,
+                                         'count': stat.count}
+                                        for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]]
+                }
+        else:
+            yield
+
+    def skip_stage(self, name: str, reason: str):
+        """ Record a stage that was not run. """
+        logging.info("skipping stage {s}: {r}".format(s=name, r=reason))
+        self.report['stages'].append({'name': name, 'status': 'skipped', 'reason': reason})
+
+    def save(self) -> str:
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.report, f, indent=2, default=str)
+        os.replace(self.path + '.tmp', self.path)
+        logging.info("run report saved to {p}".format(p=self.path))
+        return self.path
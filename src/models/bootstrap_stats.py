@@ -0,0 +1,74 @@
+import numpy as np
+
+from src.config import BOOTSTRAP_QUANTILES, BOOTSTRAP_RESERVOIR_SIZE, BOOTSTRAP_RESERVOIR_MAX_MB
+
+
+class BootstrapAccumulator:
+    """
+    Streaming statistics over bootstrap simulations, updated one chunk of simulations at a time.
+    Mean and variance of each row are exact (Welford updates merged chunk by chunk), while quantiles are computed on a
+    uniform reservoir of at most reservoir_size simulations, so memory does not grow with the number of simulations.
+    If reservoir_size is not given, the reservoir is also kept within BOOTSTRAP_RESERVOIR_MAX_MB for long series.
+    """
+
+    def __init__(self, n_rows: int, quantiles: tuple = None, reservoir_size: int = None, random_state=None):
+        if quantiles is None:
+            quantiles = BOOTSTRAP_QUANTILES
+        if reservoir_size is None:
+            max_size = int(BOOTSTRAP_RESERVOIR_MAX_MB * 2 ** 20 // max(4 * n_rows, 1))
+            reservoir_size = max(2, min(BOOTSTRAP_RESERVOIR_SIZE, max_size))
+        self.quantiles = quantiles
+        self.count = 0
+        self._mean = np.zeros(n_rows)
+        self._m2 = np.zeros(n_rows)
+        self._reservoir = np.empty((reservoir_size, n_rows), dtype=np.float32)
+        self._rng = np.random.RandomState(random_state)
+
+    def update(self, chunk: np.ndarray):
+        """
+        Add a chunk of simulations
+        :param chunk: array with shape (simulations in chunk, rows)
+        """
+        n_chunk = chunk.shape[0]
+        if n_chunk == 0:
+            return
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        n_total = self.count + n_chunk
+        delta = chunk_mean - self._mean
+        self._mean += delta * n_chunk / n_total
+        self._m2 += chunk_m2 + delta ** 2 * self.count * n_chunk / n_total
+        self._update_reservoir(chunk)
+        self.count = n_total
+
+    def _update_reservoir(self, chunk: np.ndarray):
+        reservoir_size = self._reservoir.shape[0]
+        for i, simulation in enumerate(chunk):
+            position = self.count + i
+            if position >= reservoir_size:
+                position = self._rng.randint(0, position + 1)
+            if position < reservoir_size:
+                self._reservoir[position] = simulation
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self._mean
+
+    @property
+    def std(self) -> np.ndarray:
+        if self.count < 2:
+            return np.full_like(self._mean, np.nan)
+        return np.sqrt(self._m2 / (self.count - 1))
+
+    def quantile(self, q: float) -> np.ndarray:
+        n_kept = min(self.count, self._reservoir.shape[0])
+        return np.quantile(self._reservoir[:n_kept], q, axis=0)
+
+    def to_dict(self, prefix: str = 'valore') -> dict:
+        """
+        Summarize simulations as columns named after prefix: mean, standard deviation and each quantile
+        """
+        summary = {prefix: self.mean, prefix + '_std': self.std}
+        for q in self.quantiles:
+            summary['{p}_p{q}'.format(p=prefix, q=round(q * 100))] = self.quantile(q)
+        return summary
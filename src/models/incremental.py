@@ -0,0 +1,92 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+import pandas as pd
+
+from src.config import NORM_STATE_DIR, NORM_REFIT_DAYS, NORM_DRIFT_THRESHOLD, RANDOM_FOREST_CONFIG, BOOTSTRAP_SAMPLES, \
+    BOOTSTRAP_QUANTILES, BOOTSTRAP_RESERVOIR_SIZE, BOOTSTRAP_RESERVOIR_MAX_MB
+
+
+def frame_fingerprint(dataset: pd.DataFrame, dt_col: str = 'data') -> str:
+    """ Hash the content of a dataframe, independently of its row order and index. """
+    sorted_dataset = dataset.sort_values(dt_col, kind='mergesort').reset_index(drop=True)
+    digest = hashlib.sha256(str(list(sorted_dataset.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(sorted_dataset, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def config_fingerprint(features: list, bootstrap_features: list, random_state: int = None) -> str:
+    """
+    Hash every setting that changes the normalized output of a sensor, including the quantiles and reservoir of the
+    uncertainty columns and the seed of the bootstrap.
+    """
+    config = {
+        'features': features,
+        'bootstrap_features': bootstrap_features,
+        'random_forest': RANDOM_FOREST_CONFIG,
+        'bootstrap_samples': BOOTSTRAP_SAMPLES,
+        'bootstrap_quantiles': BOOTSTRAP_QUANTILES,
+        'bootstrap_reservoir_size': BOOTSTRAP_RESERVOIR_SIZE,
+        'bootstrap_reservoir_max_mb': BOOTSTRAP_RESERVOIR_MAX_MB,
+        'random_state': random_state
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _state_path(sensor: str) -> str:
+    return os.path.join(NORM_STATE_DIR, 'sensor_{}.pkl'.format(sensor))
+
+
+def load_sensor_state(sensor: str) -> dict:
+    """ Load the state saved by the last normalization of sensor, None if it has never been normalized. """
+    path = _state_path(sensor)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_sensor_state(sensor: str, state: dict):
+    os.makedirs(NORM_STATE_DIR, exist_ok=True)
+    path = _state_path(sensor)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def plan_sensor_update(state: dict, dataset: pd.DataFrame, config_hash: str, data_hash: str) -> str:
+    """
+    Decide how to update the normalization of a sensor:
+    - 'skip' if neither data nor configuration changed since last run;
+    - 'append' if new days were only appended to the data used by last fit, which is still recent enough;
+    - 'refit' otherwise.
+    """
+    if state is None or state['config'] != config_hash:
+        return 'refit'
+    if state['data'] == data_hash:
+        return 'skip'
+    if datetime.datetime.now() - state['fitted_at'] >= datetime.timedelta(days=NORM_REFIT_DAYS):
+        logging.info("last fit is older than {d} days".format(d=NORM_REFIT_DAYS))
+        return 'refit'
+    old_dataset = dataset.loc[dataset['data'] <= state['last_date']]
+    if len(old_dataset) < len(dataset) and frame_fingerprint(old_dataset) == state['data']:
+        return 'append'
+    return 'refit'
+
+
+def has_drifted(state: dict, prediction: pd.Series, y: pd.Series) -> bool:
+    """
+    Detect drift on new days: the mean absolute error of the stored model is compared with the standard deviation of
+    the target used for training, scaled by NORM_DRIFT_THRESHOLD.
+    """
+    errors = (y.reindex(prediction.index) - prediction).abs().dropna()
+    if len(errors) == 0:
+        return False
+    mae = errors.mean()
+    logging.info("MAE on new days {m:.3f}, training target std {s:.3f}".format(m=mae, s=state['train_std']))
+    return mae > NORM_DRIFT_THRESHOLD * state['train_std']
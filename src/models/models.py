@@ -1,9 +1,11 @@
 import logging
 from abc import ABC, abstractmethod
+import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
 
-from src.config import RANDOM_FOREST_CONFIG, FEAT_WEATHER_COLS, FEAT_DATE_COLS
+from src.config import RANDOM_FOREST_CONFIG, FEAT_WEATHER_COLS, FEAT_DATE_COLS, BOOTSTRAP_CHUNK_SIZE, \
+    BOOTSTRAP_MAX_BATCH_MB
 from src.models.evaluation import compute_time_series_metrics
 
 
@@ -45,43 +47,88 @@ class TimeSeriesScoringModel(ABC):
 class WeatherModel(TimeSeriesScoringModel):
 
     def __init__(self, model_type, features: list = None, bootstrap_features: list = None,
-                 bootstrap: bool = False):
+                 bootstrap: bool = False, random_state: int = None):
         if model_type == 'random_forest':
-            self._model = RandomForestRegressor(**RANDOM_FOREST_CONFIG)
+            rf_config = dict(RANDOM_FOREST_CONFIG)
+            if random_state is not None:
+                rf_config['random_state'] = random_state
+            self._model = RandomForestRegressor(**rf_config)
         else:
             raise NotImplementedError('specified model is not available')
         self.features = features
         self.bootstrap_features = bootstrap_features
         self.bootstrap = bootstrap
+        self._rng = np.random.RandomState(random_state)
+        self.train_start = None
+        self.train_end = None
+        self.n_train = 0
 
     def _select_features(self, x: pd.DataFrame):
         if self.features is None:
             self.features = ['date_unix'] + FEAT_DATE_COLS + FEAT_WEATHER_COLS
         try:
-            new_x = x[self.features].copy()
+            new_x = x[self.features]
             return new_x
         except KeyError as e:
             raise RuntimeError(f'Cannot select required features: {str(e)}') from e
 
-    def _bootstrap_features(self, x: pd.DataFrame) -> pd.DataFrame:
-        x_btsp = x.reset_index()
-        x_btsp.loc[:, self.bootstrap_features] = x_btsp.loc[:, self.bootstrap_features].sample(frac=1,
-                                                                                           replace=True).reset_index()
-        x_btsp = x_btsp.set_index('data')
-        return x_btsp
+    def feature_matrix(self, x: pd.DataFrame) -> tuple:
+        """
+        Select model features and convert them once to a float32 array, dropping rows with missing values
+        :param x: feature matrix
+        :return: a tuple (index of kept rows, numpy array of features)
+        """
+        x_sel = self._select_features(x)
+        x_matrix = x_sel.to_numpy(dtype=np.float32)
+        not_na = ~np.isnan(x_matrix).any(axis=1)
+        return x_sel.index[not_na], x_matrix[not_na]
+
+    def predict_bootstrap(self, x_matrix: np.ndarray, n_samples: int, chunk_size: int = None,
+                          x_pool: np.ndarray = None):
+        """
+        Score n_samples bootstrap simulations, where bootstrap features are resampled with replacement from the rows
+        of x_pool. Simulations are stacked in chunks of chunk_size and scored by a single forest predict; chunks are
+        made smaller if needed to keep stacked features within BOOTSTRAP_MAX_BATCH_MB (e.g. for hourly data).
+        :param x_matrix: feature array as returned by feature_matrix
+        :param n_samples: number of bootstrap simulations
+        :param chunk_size: number of simulations scored together
+        :param x_pool: feature array bootstrap features are drawn from, x_matrix if None
+        :return: a generator of arrays with shape (simulations in chunk, rows of x_matrix)
+        """
+        if chunk_size is None:
+            chunk_size = BOOTSTRAP_CHUNK_SIZE
+        if x_pool is None:
+            x_pool = x_matrix
+        n_rows = x_matrix.shape[0]
+        row_bytes = n_rows * (x_matrix.shape[1] * x_matrix.itemsize + 8)
+        chunk_size = max(1, min(chunk_size, int(BOOTSTRAP_MAX_BATCH_MB * 2 ** 20 // max(row_bytes, 1))))
+        btsp_cols = [self.features.index(f) for f in self.bootstrap_features or []]
+        for start in range(0, n_samples, chunk_size):
+            n_chunk = min(chunk_size, n_samples - start)
+            stacked = np.tile(x_matrix, (n_chunk, 1))
+            if len(btsp_cols) > 0 and x_pool.shape[0] > 0:
+                btsp_idx = self._rng.randint(0, x_pool.shape[0], size=n_chunk * n_rows)
+                stacked[:, btsp_cols] = x_pool[btsp_idx[:, None], btsp_cols]
+            yield self._model.predict(stacked).reshape(n_chunk, n_rows)
 
     def fit(self, x: pd.DataFrame, y: pd.Series):
-        x_train = x.copy()
-        x_train = self._select_features(x_train).dropna()
+        x_train = self._select_features(x).dropna()
         y_train = y[x_train.index].dropna()
         x_train = x_train.loc[y_train.index, :]
         logging.info("Training model")
-        self._model.fit(x_train, y_train)
+        self._model.fit(x_train.to_numpy(dtype=np.float32), y_train.to_numpy())
+        self.train_start = x_train.index.min()
+        self.train_end = x_train.index.max()
+        self.n_train = len(x_train)
         return self
 
-    def predict(self, x: pd.DataFrame):
-        x_test = self._select_features(x).dropna()
-        if self.bootstrap:
-            x_test = self._bootstrap_features(x_test)
-        prediction = pd.Series(self._model.predict(x_test), index=x_test.index)
+    def predict(self, x: pd.DataFrame, bootstrap: bool = None):
+        if bootstrap is None:
+            bootstrap = self.bootstrap
+        index, x_test = self.feature_matrix(x)
+        if bootstrap:
+            predicted = next(self.predict_bootstrap(x_test, n_samples=1))[0]
+        else:
+            predicted = self._model.predict(x_test)
+        prediction = pd.Series(predicted, index=index)
         return prediction
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import argparse
 import os
 import logging
 import sys
@@ -10,15 +11,34 @@ warnings.filterwarnings('ignore')
 from src.models.train_model import pipeline_normalize_multi_sensors
 
 
-def predict_normalized_pollutant():
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--executor",
+                        help="[serial] how sensors are normalized: serial, thread or process",
+                        required=False, default=None, choices=['serial', 'thread', 'process'])
+    parser.add_argument("-w", "--workers",
+                        help="[None] number of workers used by thread or process executor",
+                        required=False, default=None, type=int)
+    parser.add_argument("-f", "--full_refit",
+                        help="[False] every sensor is refitted instead of reusing the state of the last run",
+                        required=False, default=False, action="store_true")
+    args = parser.parse_args()
+    return args.executor, args.workers, args.full_refit
+
+
+def predict_normalized_pollutant(executor: str = None, n_workers: int = None, full_refit: bool = False):
     """
     Build total dataset merging ARPA air quality data with weather data.
+    Sensors can be normalized in parallel choosing a thread or process executor.
+    Unless full_refit is set, sensors whose data did not change since last run are skipped.
     """
     logging.info('normalize all sensors available into dataset')
-    pipeline_normalize_multi_sensors()
+    incremental = False if full_refit else None
+    pipeline_normalize_multi_sensors(executor=executor, n_workers=n_workers, incremental=incremental)
 
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
-    predict_normalized_pollutant()
+    executor, n_workers, full_refit = parse_args()
+    predict_normalized_pollutant(executor=executor, n_workers=n_workers, full_refit=full_refit)
@@ -0,0 +1,99 @@
+import datetime
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import joblib
+
+from src.config import MODEL_REGISTRY_DIR, MODEL_REGISTRY_MAX_RESIDENT
+
+
+class ModelRegistry:
+    """
+    Persistent store of fitted WeatherModel instances, one per sensor, saved with joblib next to a json file of
+    metadata (features and training window).
+    Models are loaded lazily with memory-mapped arrays, so that many workers or app sessions share the same copy of
+    the trees; at most max_resident models are kept in memory, the least recently used is evicted first.
+    """
+
+    def __init__(self, registry_dir: str = None, max_resident: int = None, mmap_mode: str = 'r'):
+        if registry_dir is None:
+            registry_dir = MODEL_REGISTRY_DIR
+        if max_resident is None:
+            max_resident = MODEL_REGISTRY_MAX_RESIDENT
+        self.registry_dir = registry_dir
+        self.max_resident = max_resident
+        self.mmap_mode = mmap_mode
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _model_path(self, sensor: str) -> str:
+        return os.path.join(self.registry_dir, 'sensor_{}.joblib'.format(sensor))
+
+    def _metadata_path(self, sensor: str) -> str:
+        return os.path.join(self.registry_dir, 'sensor_{}.json'.format(sensor))
+
+    def _make_resident(self, sensor: str, model):
+        self._resident[sensor] = model
+        self._resident.move_to_end(sensor)
+        while len(self._resident) > self.max_resident:
+            evicted, _ = self._resident.popitem(last=False)
+            logging.debug("evicting model of sensor {s} from memory".format(s=evicted))
+
+    def save(self, sensor: str, model, metadata: dict = None):
+        """ Save a fitted model for sensor together with its feature list, training window and extra metadata. """
+        os.makedirs(self.registry_dir, exist_ok=True)
+        model_metadata = {
+            'sensor': sensor,
+            'features': model.features,
+            'bootstrap_features': model.bootstrap_features,
+            'train_start': str(model.train_start),
+            'train_end': str(model.train_end),
+            'n_train': model.n_train,
+            'saved_at': datetime.datetime.now().isoformat()
+        }
+        model_metadata.update(metadata or {})
+        model_path = self._model_path(sensor)
+        logging.info("saving model of sensor {s} to {p}".format(s=sensor, p=model_path))
+        joblib.dump(model, model_path + '.tmp')
+        os.replace(model_path + '.tmp', model_path)
+        with open(self._metadata_path(sensor) + '.tmp', 'w') as f:
+            json.dump(model_metadata, f, indent=2)
+        os.replace(self._metadata_path(sensor) + '.tmp', self._metadata_path(sensor))
+        with self._lock:
+            self._make_resident(sensor, model)
+
+    def load(self, sensor: str):
+        """ Return the model of sensor, loading it from disk if not resident. None if sensor has no saved model. """
+        with self._lock:
+            if sensor in self._resident:
+                self._resident.move_to_end(sensor)
+                return self._resident[sensor]
+        model_path = self._model_path(sensor)
+        if not os.path.exists(model_path):
+            return None
+        logging.info("loading model of sensor {s} from {p}".format(s=sensor, p=model_path))
+        model = joblib.load(model_path, mmap_mode=self.mmap_mode)
+        with self._lock:
+            self._make_resident(sensor, model)
+        return model
+
+    def metadata(self, sensor: str) -> dict:
+        with open(self._metadata_path(sensor)) as f:
+            return json.load(f)
+
+    def sensors(self) -> list:
+        if not os.path.isdir(self.registry_dir):
+            return []
+        return sorted(f[len('sensor_'):-len('.joblib')] for f in os.listdir(self.registry_dir)
+                      if f.startswith('sensor_') and f.endswith('.joblib'))
+
+    def evict(self, sensor: str = None):
+        """ Drop sensor, or every model if sensor is None, from memory. Saved files are kept. """
+        with self._lock:
+            if sensor is None:
+                self._resident.clear()
+            else:
+                self._resident.pop(sensor, None)
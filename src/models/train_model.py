@@ -1,15 +1,31 @@
+import datetime
 import logging
 import os
 import pandas as pd
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
 
 sys.path.append(os.getcwd())
 
-from src.config import BOOTSTRAP_SAMPLES, FEAT_WEATHER_COLS, FEAT_CAL_COLS, PROC_DATA_DIR
-from src.data.common_funcs import load_dataset
-from src.features.build_features import build_dataset_features
+from src.config import BOOTSTRAP_SAMPLES, BOOTSTRAP_CHUNK_SIZE, FEAT_WEATHER_COLS, FEAT_CAL_COLS, \
+    FEAT_HOUR_HARMONIC_PERIODS, NORMALIZATION_SEED, NORMALIZATION_EXECUTOR, NORMALIZATION_WORKERS, \
+    NORMALIZATION_INCREMENTAL
+from src.data.common_funcs import load_dataset, load_facts, load_date_dimension
+from src.data.storage import save_frame
+from src.features.build_features import build_dataset_features, join_date_features
+from src.features.seasonality_features import harmonic_columns
+from src.instrumentation import call_measured, record_item, record_rows
+from src.models.bootstrap_stats import BootstrapAccumulator
+from src.models.incremental import frame_fingerprint, config_fingerprint, load_sensor_state, save_sensor_state, \
+    plan_sensor_update, has_drifted
 from src.models.models import WeatherModel
+from src.models.registry import ModelRegistry
+
+# registry of the current process, shared by the sensors it normalizes (see _worker_registry)
+_registry = None
+_registry_lock = threading.Lock()
 
 
 def x_y_train_test_split(dataset: pd.DataFrame, year_test: int = None, y_col: str = 'valore') -> tuple:
@@ -55,27 +71,106 @@ def train_test_pipeline():
     return compare_df
 
 
-def bootstrap_normalization(model, x):
-    result_df = pd.DataFrame()
-    for i in tqdm(range(BOOTSTRAP_SAMPLES + 1)):
-        result_df["sim_" + str(i)] = model.predict(x)
-    normalized_df = result_df.mean(axis=1)
-    normalized_df = normalized_df.reset_index()
-    normalized_df.columns = ['data', 'valore']
+def bootstrap_normalization(model, x, n_samples: int = None, random_state: int = None, x_pool=None):
+    """
+    Average model predictions over bootstrap simulations. Simulations are accumulated chunk by chunk, so memory does
+    not depend on n_samples; standard deviation and quantiles of the simulations are returned as uncertainty columns.
+    Bootstrap features are resampled from x_pool if given, from x otherwise.
+    """
+    if n_samples is None:
+        n_samples = BOOTSTRAP_SAMPLES + 1
+    index, x_matrix = model.feature_matrix(x)
+    pool_matrix = model.feature_matrix(x_pool)[1] if x_pool is not None else None
+    accumulator = BootstrapAccumulator(n_rows=len(index), random_state=random_state)
+    n_chunks = -(-n_samples // BOOTSTRAP_CHUNK_SIZE)
+    for chunk in tqdm(model.predict_bootstrap(x_matrix, n_samples=n_samples, x_pool=pool_matrix), total=n_chunks):
+        accumulator.update(chunk)
+    normalized_df = pd.DataFrame({'data': index, **accumulator.to_dict(prefix='valore')})
     return normalized_df
 
 
-def normalize_from_data(dataset: pd.DataFrame):
-    dataset_with_features = build_dataset_features(dataset=dataset,sensor_dummies=False)
-    x, y = x_y_split(dataset=dataset_with_features)
+def _normalization_model(random_state: int = None, hourly: bool = False) -> WeatherModel:
     features = ['date_unix'] + FEAT_CAL_COLS + FEAT_WEATHER_COLS
+    if hourly:
+        features += ['hour'] + harmonic_columns(FEAT_HOUR_HARMONIC_PERIODS)
     bootstrap_features = [f for f in features if f != 'date_unix']
     norm_model = WeatherModel(model_type='random_forest',
                               features=features,
                               bootstrap_features=bootstrap_features,
-                              bootstrap=True)
+                              bootstrap=True,
+                              random_state=random_state)
+    return norm_model
+
+
+def _sensor_features(dataset: pd.DataFrame, date_dimension: pd.DataFrame = None) -> pd.DataFrame:
+    """ Features of a single sensor, joined from date_dimension if given, computed from dataset otherwise. """
+    if date_dimension is not None:
+        return join_date_features(facts=dataset, date_dimension=date_dimension)
+    return build_dataset_features(dataset=dataset, sensor_dummies=False)
+
+
+def normalize_from_data(dataset: pd.DataFrame, random_state: int = None, sensor: str = None,
+                        registry: ModelRegistry = None, date_dimension: pd.DataFrame = None):
+    dataset_with_features = _sensor_features(dataset=dataset, date_dimension=date_dimension)
+    x, y = x_y_split(dataset=dataset_with_features)
+    norm_model = _normalization_model(random_state=random_state, hourly='hour' in x.columns)
     norm_model.fit(x, y)
-    normalized = bootstrap_normalization(model=norm_model, x=x)
+    if registry is not None:
+        registry.save(sensor=sensor, model=norm_model)
+    normalized = bootstrap_normalization(model=norm_model, x=x, random_state=random_state)
+    return normalized
+
+
+def normalize_incremental(sensor: str, dataset: pd.DataFrame, random_state: int = None,
+                          registry: ModelRegistry = None, date_dimension: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Normalize a sensor reusing the state saved by its last run. The sensor is skipped if its data and configuration
+    are unchanged, only the new days are normalized with the model stored in registry if days were appended, and the
+    model is refitted when the configuration or old data changed, the last fit is older than NORM_REFIT_DAYS or drift
+    is detected on new days.
+    If date_dimension is given, measures are joined to it first, so that changes of weather data are detected too.
+    """
+    if registry is None:
+        registry = ModelRegistry()
+    if date_dimension is not None:
+        dataset = join_date_features(facts=dataset, date_dimension=date_dimension).reset_index()
+    norm_model = _normalization_model(random_state=random_state, hourly='hour' in dataset.columns)
+    config_hash = config_fingerprint(features=norm_model.features, bootstrap_features=norm_model.bootstrap_features,
+                                     random_state=random_state)
+    data_hash = frame_fingerprint(dataset)
+    state = load_sensor_state(sensor)
+    update = plan_sensor_update(state=state, dataset=dataset, config_hash=config_hash, data_hash=data_hash)
+    if update == 'skip':
+        logging.info("sensor {s} is unchanged, skipping".format(s=sensor))
+        return state['normalized']
+    last_date = dataset['data'].max()
+    if date_dimension is not None:
+        dataset_with_features = dataset.set_index('data')
+    else:
+        dataset_with_features = build_dataset_features(dataset=dataset, sensor_dummies=False)
+    x, y = x_y_split(dataset=dataset_with_features)
+    stored_model = registry.load(sensor) if update == 'append' else None
+    if stored_model is not None:
+        new_x = x.loc[x.index > state['last_date']]
+        if not has_drifted(state=state, prediction=stored_model.predict(new_x, bootstrap=False), y=y):
+            logging.info("normalizing {n} new days for sensor {s}".format(n=len(new_x), s=sensor))
+            normalized_new = bootstrap_normalization(model=stored_model, x=new_x, random_state=random_state, x_pool=x)
+            normalized = pd.concat([state['normalized'], normalized_new], ignore_index=True)
+            state.update({'data': data_hash, 'last_date': last_date, 'normalized': normalized})
+            save_sensor_state(sensor=sensor, state=state)
+            return normalized
+        logging.info("drift detected for sensor {s}, refitting".format(s=sensor))
+    norm_model.fit(x, y)
+    registry.save(sensor=sensor, model=norm_model, metadata={'config': config_hash})
+    normalized = bootstrap_normalization(model=norm_model, x=x, random_state=random_state)
+    save_sensor_state(sensor=sensor, state={
+        'config': config_hash,
+        'data': data_hash,
+        'last_date': last_date,
+        'fitted_at': datetime.datetime.now(),
+        'train_std': y.std(),
+        'normalized': normalized
+    })
     return normalized
 
 
@@ -85,24 +180,94 @@ def normalize_pollutant_pipeline(filter_dict: dict, sensor_dummies: bool = None)
         sensor_dummies = False
     if not sensor_dummies:
         dataset = filter_by_sensor(dataset=dataset, filter_dict=filter_dict)
-    normalized = normalize_from_data(dataset, sensor_dummies)
+    normalized = normalize_from_data(dataset)
     return normalized
 
 
-def pipeline_normalize_multi_sensors(sensors_list: list = None):
-    dataset = load_dataset()
+def _worker_registry() -> ModelRegistry:
+    """
+    Model registry of the current process, created on first use: the serial loop and thread pool workers share it,
+    and each process pool worker creates its own once, so resident and memory-mapped models are reused across sensors.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+    return _registry
+
+
+def _normalize_sensor(sensor: str, sensor_dataset: pd.DataFrame, random_state: int = None,
+                      incremental: bool = False, date_dimension: pd.DataFrame = None,
+                      registry: ModelRegistry = None) -> pd.DataFrame:
+    """
+    Normalize a single sensor, storing its model in registry, the registry of the worker by default. Defined at
+    module level so that it can be sent to a process pool.
+    """
+    logging.info("normalizing data for sensor " + sensor)
+    if registry is None:
+        registry = _worker_registry()
+    if incremental:
+        norm_sensor = normalize_incremental(sensor=sensor, dataset=sensor_dataset, random_state=random_state,
+                                            registry=registry, date_dimension=date_dimension)
+    else:
+        norm_sensor = normalize_from_data(dataset=sensor_dataset, random_state=random_state, sensor=sensor,
+                                          registry=registry, date_dimension=date_dimension)
+    norm_sensor['idsensore'] = sensor
+    return norm_sensor
+
+
+def _get_executor(executor: str, n_workers: int = None):
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=n_workers)
+    if executor == 'process':
+        return ProcessPoolExecutor(max_workers=n_workers)
+    raise NotImplementedError("executor {e} is not available".format(e=executor))
+
+
+def pipeline_normalize_multi_sensors(sensors_list: list = None, executor: str = None, n_workers: int = None,
+                                     random_state: int = None, incremental: bool = None):
+    """
+    Normalize every sensor in sensors_list and save the result as normalized_dataset.
+    Sensors are independent, so they can be sent to a 'thread' or 'process' pool of n_workers instead of
+    the default 'serial' loop. Each sensor uses the same random_state, so the output does not depend on the executor.
+    If incremental, sensors reuse the state of the last run (see normalize_incremental).
+    Sensor measures are joined to the date dimension of the dataset, whose features are computed once for all sensors.
+    Time, memory and rows of each sensor are recorded into the run report, if any (see src.instrumentation).
+    """
+    if executor is None:
+        executor = NORMALIZATION_EXECUTOR
+    if n_workers is None:
+        n_workers = NORMALIZATION_WORKERS
+    if random_state is None:
+        random_state = NORMALIZATION_SEED
+    if incremental is None:
+        incremental = NORMALIZATION_INCREMENTAL
+    dataset = load_facts()
+    date_dimension = load_date_dimension()
     if sensors_list is None:
         sensors_list = dataset['idsensore'].unique().tolist()
     sensors_dataset = dataset.loc[dataset['idsensore'].isin(sensors_list)]
-    normalized_dataset = pd.DataFrame()
-    for sensor in tqdm(sensors_list):
-        sensor_dataset = sensors_dataset.loc[sensors_dataset['idsensore']==sensor]
-        logging.info("normalizing data for sensor " + sensor)
-        norm_sensor = normalize_from_data(dataset=sensor_dataset)
-        norm_sensor['idsensore'] = sensor
-        normalized_dataset = pd.concat([normalized_dataset, norm_sensor])
-    output_pkl = os.path.join(PROC_DATA_DIR, 'normalized_dataset.pkl')
-    normalized_dataset.to_pickle(output_pkl)
+    sensors_datasets = [sensors_dataset.loc[sensors_dataset['idsensore'] == sensor] for sensor in sensors_list]
+    seeds = [random_state] * len(sensors_list)
+    incrementals = [incremental] * len(sensors_list)
+    date_dimensions = [date_dimension] * len(sensors_list)
+    funcs = [_normalize_sensor] * len(sensors_list)
+    logging.info("normalizing {n} sensors with {e} executor".format(n=len(sensors_list), e=executor))
+    if executor == 'serial':
+        measured_sensors = [call_measured(*args) for args in tqdm(
+            zip(funcs, sensors_list, sensors_datasets, seeds, incrementals, date_dimensions), total=len(sensors_list))]
+    else:
+        with _get_executor(executor=executor, n_workers=n_workers) as pool:
+            measured_sensors = list(tqdm(
+                pool.map(call_measured, funcs, sensors_list, sensors_datasets, seeds, incrementals, date_dimensions),
+                total=len(sensors_list)))
+    norm_sensors = []
+    for sensor, sensor_dataset, (norm_sensor, metrics) in zip(sensors_list, sensors_datasets, measured_sensors):
+        record_item(item=sensor, metrics=metrics, rows_in=len(sensor_dataset))
+        norm_sensors.append(norm_sensor)
+    normalized_dataset = pd.concat(norm_sensors) if len(norm_sensors) > 0 else pd.DataFrame()
+    save_frame(normalized_dataset, name='normalized_dataset')
+    record_rows(rows_in=len(sensors_dataset), rows_out=len(normalized_dataset))
 
 
 if __name__ == '__main__':
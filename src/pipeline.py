@@ -0,0 +1,179 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.config import PIPELINE_STATE_PATH, PIPELINE_WORKERS
+from src.instrumentation import RunReport
+
+
+def path_fingerprint(paths: list) -> str:
+    """
+    Hash name, size and modification time of every file in paths, walking directories such as partitioned parquet
+    datasets. Missing paths are hashed as missing. File contents are not read, so this takes milliseconds.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, f) for root, _, dir_files in os.walk(path) for f in dir_files)
+        else:
+            files = [path]
+        for file in files:
+            if not os.path.exists(file):
+                digest.update('{f}:missing;'.format(f=file).encode())
+                continue
+            stat = os.stat(file)
+            digest.update('{f}:{s}:{m};'.format(f=os.path.relpath(file, path), s=stat.st_size,
+                                                m=stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+class Stage:
+    """
+    A step of the pipeline: func is called without arguments, reading the files in inputs and writing the files in
+    outputs (files or directories) once the stages in deps are done.
+    A remote stage also reads from the network, so its input files do not tell whether it is up to date: it always
+    runs, relying on its own incremental logic. params are the settings that change its outputs.
+    """
+
+    def __init__(self, name: str, func, inputs: list = None, outputs: list = None, deps: list = None,
+                 remote: bool = False, params: dict = None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.deps = deps or []
+        self.remote = remote
+        self.params = params or {}
+
+    def fingerprint(self, paths: list) -> str:
+        digest = hashlib.sha256(path_fingerprint(paths).encode())
+        digest.update(json.dumps(self.params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+
+def load_pipeline_state(state_path: str = None) -> dict:
+    """ Input and output fingerprints of the last successful run of each stage. """
+    if state_path is None:
+        state_path = PIPELINE_STATE_PATH
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def _save_pipeline_state(state: dict, state_path: str):
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def _check_stages(stages: list, names: list):
+    stage_names = [stage.name for stage in stages]
+    unknown = [name for name in names if name not in stage_names]
+    if len(unknown) > 0:
+        raise ValueError("unknown stages {u}, available stages are {s}".format(u=unknown, s=stage_names))
+
+
+class PipelineRunner:
+    """
+    Run stages as a DAG: each stage starts as soon as the stages it depends on are done, so independent stages run
+    concurrently on a pool of n_workers threads.
+    A stage is skipped when the fingerprints of its inputs and outputs, and its params, match those of its last
+    successful run. Each stage is measured in report, if given.
+    """
+
+    def __init__(self, stages: list, state_path: str = None, n_workers: int = None, report: RunReport = None):
+        if state_path is None:
+            state_path = PIPELINE_STATE_PATH
+        if n_workers is None:
+            n_workers = PIPELINE_WORKERS
+        _check_stages(stages=stages, names=[dep for stage in stages for dep in stage.deps])
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.n_workers = n_workers
+        self.report = report
+        self.state = load_pipeline_state(state_path=state_path)
+
+    def _is_current(self, stage: Stage) -> bool:
+        last_run = self.state.get(stage.name)
+        if stage.remote or last_run is None:
+            return False
+        return last_run['inputs'] == stage.fingerprint(stage.inputs) and \
+            last_run['outputs'] == stage.fingerprint(stage.outputs)
+
+    def _run_stage(self, stage: Stage, force: bool) -> str:
+        if not force and self._is_current(stage):
+            if self.report is not None:
+                self.report.skip_stage(stage.name, reason='inputs unchanged since last run')
+            else:
+                logging.info("skipping stage {s}: inputs unchanged since last run".format(s=stage.name))
+            return 'skipped'
+        inputs_fingerprint = stage.fingerprint(stage.inputs)
+        self.state.pop(stage.name, None)
+        if self.report is not None:
+            with self.report.stage(stage.name):
+                stage.func()
+        else:
+            logging.info("running stage {s}".format(s=stage.name))
+            stage.func()
+        self.state[stage.name] = {
+            'inputs': inputs_fingerprint,
+            'outputs': stage.fingerprint(stage.outputs),
+            'finished_at': datetime.datetime.now().isoformat()
+        }
+        return 'succeeded'
+
+    def _schedule(self, pending: list, running: dict, outcomes: dict, force: list, pool: ThreadPoolExecutor):
+        """ Submit pending stages whose dependencies are done and block those with a failed dependency. """
+        for name in list(pending):
+            dep_outcomes = [outcomes.get(dep) for dep in self.stages[name].deps]
+            if any(outcome in ('failed', 'blocked') for outcome in dep_outcomes):
+                logging.error("stage {s} is blocked by a failed dependency".format(s=name))
+                outcomes[name] = 'blocked'
+                pending.remove(name)
+            elif all(outcome is not None for outcome in dep_outcomes):
+                stage_force = force is not None and (len(force) == 0 or name in force)
+                running[pool.submit(self._run_stage, self.stages[name], stage_force)] = name
+                pending.remove(name)
+
+    @staticmethod
+    def _collect(running: dict, outcomes: dict):
+        """ Wait for at least one running stage to end and record the outcome of those that ended. """
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            try:
+                outcomes[name] = future.result()
+            except Exception:
+                logging.exception("stage {s} failed".format(s=name))
+                outcomes[name] = 'failed'
+
+    def run(self, only: list = None, force: list = None) -> dict:
+        """
+        Run the stages named in only (all by default), in dependency order; stages outside only are considered done
+        and their current outputs are used. Stages named in force run even if up to date; force=[] forces every stage.
+        Return the outcome of each selected stage: 'succeeded', 'skipped', 'failed' or 'blocked' by a failed dependency.
+        The state of stages that succeeded is saved even if others failed.
+        """
+        if only is not None:
+            _check_stages(stages=self.stages.values(), names=only)
+        if force:
+            _check_stages(stages=self.stages.values(), names=force)
+        selected = [name for name in self.stages if only is None or name in only]
+        outcomes = {name: 'done' for name in self.stages if name not in selected}
+        pending = list(selected)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            while pending or running:
+                n_pending = len(pending)
+                self._schedule(pending=pending, running=running, outcomes=outcomes, force=force, pool=pool)
+                if running:
+                    self._collect(running=running, outcomes=outcomes)
+                elif len(pending) == n_pending:
+                    raise ValueError("circular dependencies between stages {p}".format(p=pending))
+        _save_pipeline_state(state=self.state, state_path=self.state_path)
+        return {name: outcomes[name] for name in selected}
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+
+import pandas as pd
+
+sys.path.append(os.getcwd())
+
+from src.config import DASHBOARD_DIR, DASHBOARD_NA_PER_SENSOR
+from src.data.common_funcs import load_facts, load_normalized_dataset
+from src.instrumentation import record_rows
+from src.visualization.visualize import avg_by_date, reindex_data, summarize_sensors, yearly_avg_matrix
+
+DASHBOARD_KINDS = ['raw', 'norm']
+DASHBOARD_INDEX = 'index.json'
+
+
+def _type_dir(sensor_type: str) -> str:
+    return re.sub('[^0-9A-Za-z]+', '_', sensor_type).strip('_')
+
+
+def _artifact_path(sensor_type: str, artifact: str, dashboard_dir: str = None) -> str:
+    if dashboard_dir is None:
+        dashboard_dir = DASHBOARD_DIR
+    return os.path.join(dashboard_dir, _type_dir(sensor_type), artifact + '.parquet')
+
+
+def sensor_lines_since(sensor_lines: pd.DataFrame, since_year: int) -> pd.DataFrame:
+    """
+    Wide sensor x date matrix of daily measures since since_year, one column per sensor with data in the period,
+    reindexed on every day, and the 'med' line summarizing sensors.
+    """
+    lines = sensor_lines.loc[sensor_lines.index.year >= since_year].dropna(axis=1, how='all')
+    if len(lines) == 0:
+        return lines.reset_index()
+    lines = reindex_data(df=lines.reset_index())
+    if len(lines.columns) > 1:
+        lines['med'] = summarize_sensors(lines=lines.set_index('data'), na_per_sensor=DASHBOARD_NA_PER_SENSOR).values
+    return lines
+
+
+def _type_artifacts(data: pd.DataFrame, since_years: list) -> dict:
+    # lines are daily: measures of hourly datasets are averaged by day, as reindex_data would keep midnight ones only
+    sensor_lines = data.assign(data=data['data'].dt.normalize()).pivot_table(index='data', columns='idsensore',
+                                                                             values='valore')
+    sensor_lines.columns = sensor_lines.columns.astype(str)
+    artifacts = {'lines_since_{y}'.format(y=year): sensor_lines_since(sensor_lines=sensor_lines, since_year=year)
+                 for year in since_years}
+    artifacts['by_date'] = avg_by_date(data=data)
+    yearly_matrix = yearly_avg_matrix(data=data)
+    yearly_matrix.columns = yearly_matrix.columns.astype(str)
+    artifacts['yearly_matrix'] = yearly_matrix.reset_index()
+    return artifacts
+
+
+def build_dashboard_aggregates(dashboard_dir: str = None) -> dict:
+    """
+    Materialize what app.py shows for every sensor type, for raw and normalized data: sensor x date matrices with their
+    median line since each year, averages by date and the years x day keys matrix of averages used for year-on-year
+    comparisons. Each artifact is a small parquet file read as is by the app, listed in an index; the previous
+    artifacts are replaced only when all the new ones are written.
+    """
+    if dashboard_dir is None:
+        dashboard_dir = DASHBOARD_DIR
+    facts = load_facts(columns=['data', 'idsensore', 'nometiposensore', 'valore'])
+    facts['idsensore'] = facts['idsensore'].astype(str)
+    sensor_types = facts.drop_duplicates('idsensore').set_index('idsensore')['nometiposensore'].astype(str)
+    norm_data = load_normalized_dataset(columns=['data', 'idsensore', 'valore'])
+    norm_data['idsensore'] = norm_data['idsensore'].astype(str)
+    data = {
+        'raw': facts.assign(nometiposensore=facts['nometiposensore'].astype(str)),
+        'norm': norm_data.assign(nometiposensore=norm_data['idsensore'].map(sensor_types))
+    }
+    since_years = sorted(facts['data'].dt.year.unique().tolist())
+    tmp_dir = dashboard_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    n_artifacts = 0
+    for sensor_type in sorted(sensor_types.unique()):
+        logging.info("building dashboard aggregates for {t}".format(t=sensor_type))
+        os.makedirs(os.path.join(tmp_dir, _type_dir(sensor_type)))
+        for kind in DASHBOARD_KINDS:
+            type_data = data[kind].loc[data[kind]['nometiposensore'] == sensor_type, ['data', 'idsensore', 'valore']]
+            for artifact, artifact_df in _type_artifacts(data=type_data, since_years=since_years).items():
+                artifact_df.to_parquet(_artifact_path(sensor_type, kind + '_' + artifact, tmp_dir), index=False)
+                n_artifacts += 1
+    index = {
+        'sensor_types': sorted(sensor_types.unique().tolist()),
+        'since_years': since_years,
+        'built_at': datetime.datetime.now().isoformat()
+    }
+    with open(os.path.join(tmp_dir, DASHBOARD_INDEX), 'w') as f:
+        json.dump(index, f, indent=2)
+    if os.path.exists(dashboard_dir):
+        shutil.rmtree(dashboard_dir + '.old', ignore_errors=True)
+        os.replace(dashboard_dir, dashboard_dir + '.old')
+        os.replace(tmp_dir, dashboard_dir)
+        shutil.rmtree(dashboard_dir + '.old')
+    else:
+        os.replace(tmp_dir, dashboard_dir)
+    record_rows(rows_in=len(facts) + len(norm_data), rows_out=n_artifacts)
+    return index
+
+
+def load_dashboard_index(dashboard_dir: str = None) -> dict:
+    if dashboard_dir is None:
+        dashboard_dir = DASHBOARD_DIR
+    with open(os.path.join(dashboard_dir, DASHBOARD_INDEX)) as f:
+        return json.load(f)
+
+
+def load_dashboard_lines(sensor_type: str, kind: str, since_year: int, dashboard_dir: str = None) -> pd.DataFrame:
+    """ Sensor x date matrix of raw or norm data of sensor_type since since_year, with its 'med' line. """
+    return pd.read_parquet(_artifact_path(sensor_type, '{k}_lines_since_{y}'.format(k=kind, y=since_year),
+                                          dashboard_dir))
+
+
+def load_avg_by_date(sensor_type: str, kind: str, dashboard_dir: str = None) -> pd.DataFrame:
+    """ Average of raw or norm data of sensor_type by date. """
+    return pd.read_parquet(_artifact_path(sensor_type, kind + '_by_date', dashboard_dir))
+
+
+def load_yearly_matrix(sensor_type: str, kind: str, dashboard_dir: str = None) -> pd.DataFrame:
+    """ Years x day keys matrix of averages of raw or norm data of sensor_type (see yearly_avg_matrix). """
+    yearly_matrix = pd.read_parquet(_artifact_path(sensor_type, kind + '_yearly_matrix', dashboard_dir))
+    yearly_matrix = yearly_matrix.set_index('year')
+    yearly_matrix.columns = yearly_matrix.columns.astype(int)
+    yearly_matrix.columns.name = 'date_comp'
+    return yearly_matrix
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    build_dashboard_aggregates()
@@ -79,7 +79,7 @@ def display_sensor_scatter(data: pd.DataFrame, weather_info: str, n_col: int = 2
     sens_cols = data['idsensore'].unique()
     n_rows = len(sens_cols) // n_col + 1
     plt.figure(figsize=(10, 5))
-    for i, (sens, sens_df) in enumerate(data.groupby('idsensore')):
+    for i, (sens, sens_df) in enumerate(data.groupby('idsensore', observed=True)):
         plt.subplot(n_rows, n_col, i + 1)
         plt.title("Effect of {w} for sensor {i}".format(w=weather_info, i=sens))
         plt.hexbin(sens_df[weather_info], sens_df['valore'], mincnt=1, bins='log', gridsize=40,
@@ -141,9 +141,9 @@ def get_yearly_avg(data: pd.DataFrame, year: int, keep_date: bool = False, day_o
     else:
         yrl_data['date_comp'] = yrl_data['data'].dt.strftime('%U-%w')
     if keep_date:
-        yrl_avg = yrl_data.groupby(['data', 'date_comp']).mean()['valore']
+        yrl_avg = yrl_data.groupby(['data', 'date_comp'])['valore'].mean()
     else:
-        yrl_avg = yrl_data.groupby(['date_comp']).mean()['valore']
+        yrl_avg = yrl_data.groupby(['date_comp'])['valore'].mean()
     return yrl_avg
 
 
@@ -191,14 +191,82 @@ def summarize_sensors(lines: pd.DataFrame, dt_as_idx: bool = True, dt_col: str =
     return summarized
 
 
-def display_year_on_year_avg_pollutant(data: pd.DataFrame, comp_year: int = None, use_st=False):
+def date_keys(dates: pd.Series, day_of_year: bool = True) -> np.ndarray:
+    """
+    Integer keys matching days of different years, as the string keys of get_yearly_avg: month * 100 + day ('%m-%d')
+    if day_of_year, otherwise week of year starting on Sunday * 10 + weekday with Sunday as 0 ('%U-%w').
+    Keys are computed on whole columns and sort as the string keys do.
+    """
+    if day_of_year:
+        return (dates.dt.month * 100 + dates.dt.day).to_numpy()
+    weekday = ((dates.dt.dayofweek + 1) % 7).to_numpy()
+    week = (dates.dt.dayofyear.to_numpy() - 1 + 7 - weekday) // 7
+    return week * 10 + weekday
+
+
+def yearly_avg_matrix(data: pd.DataFrame, day_of_year: bool = True) -> pd.DataFrame:
+    """
+    Average of valore of every year by day key (see date_keys), in a single grouped pass: a years x day keys matrix
+    whose rows are the averages get_yearly_avg returns for each year.
+    """
+    keys = date_keys(dates=data['data'], day_of_year=day_of_year)
+    matrix = data['valore'].groupby([data['data'].dt.year.to_numpy(), keys]).mean().unstack()
+    matrix.index.name = 'year'
+    matrix.columns.name = 'date_comp'
+    return matrix
+
+
+def _years_label(years: list) -> str:
+    years = sorted(years)
+    if len(years) > 1 and years == list(range(years[0], years[-1] + 1)):
+        return '{f}-{l}'.format(f=years[0], l=years[-1])
+    return '+'.join(str(y) for y in years)
+
+
+def year_on_year_from_matrix(curr_avg: pd.DataFrame, matrix: pd.DataFrame, curr_year: int, comp_years: list,
+                             day_of_year: bool = True) -> pd.DataFrame:
+    """
+    Compare the averages by date of curr_avg ('data', 'valore') with the baseline of comp_years sliced from matrix
+    (see yearly_avg_matrix): the mean of their averages by day key, every year weighting the same. Dates whose key has
+    no baseline are dropped. Columns are 'data', 'valore<curr_year>' and 'valore<comp_years>'.
+    """
+    comp_years = [year for year in comp_years if year in matrix.index]
+    if len(comp_years) == 0:
+        raise ValueError("no data for comparison years, available years are {y}".format(y=matrix.index.tolist()))
+    baseline = matrix.loc[comp_years].mean(axis=0)
+    comp_avg = baseline.reindex(date_keys(dates=curr_avg['data'], day_of_year=day_of_year)).to_numpy()
+    has_comp = ~np.isnan(comp_avg)
+    year_on_year = pd.DataFrame({'data': curr_avg['data'].to_numpy()[has_comp]})
+    year_on_year['valore' + str(curr_year)] = curr_avg['valore'].to_numpy()[has_comp]
+    year_on_year.insert(2, 'valore' + _years_label(comp_years), comp_avg[has_comp], allow_duplicates=True)
+    return year_on_year
+
+
+def avg_by_date(data: pd.DataFrame, year: int = None) -> pd.DataFrame:
+    """ Average of valore by date, of year only if given. """
+    if year is not None:
+        data = data.loc[data['data'].dt.year == year]
+    return data.groupby('data')['valore'].mean().reset_index()
+
+
+def display_year_on_year_avg_pollutant(data: pd.DataFrame, comp_year: int = None, use_st=False,
+                                       comp_years: list = None):
+    """ Compare the current year with comp_year, or with the mean of comp_years, by day of year. """
+    curr_year = datetime.datetime.now().year
+    if comp_years is None:
+        comp_years = [comp_year]
+    year_on_year = year_on_year_from_matrix(curr_avg=avg_by_date(data=data, year=curr_year),
+                                            matrix=yearly_avg_matrix(data=data), curr_year=curr_year,
+                                            comp_years=comp_years)
+    display_plotly_timestamp(lines=year_on_year, use_st=use_st)
+
+
+def display_year_on_year_from_averages(by_date: pd.DataFrame, yearly_matrix: pd.DataFrame, comp_years: list,
+                                       use_st=False):
+    """ Same as display_year_on_year_avg_pollutant, from averages precomputed by the dashboard build. """
     curr_year = datetime.datetime.now().year
-    curr_avg = get_yearly_avg(data=data, year=curr_year, keep_date=True).reset_index()
-    comp_avg = get_yearly_avg(data=data, year=comp_year).reset_index()
-    year_on_year = pd.merge(curr_avg, comp_avg, on=['date_comp'], how='inner',
-                            suffixes=(str(curr_year), str(comp_year)))
-    year_on_year = year_on_year.drop(columns=['date_comp'])
-    # year_on_year = reindex_data(df=year_on_year)
+    year_on_year = year_on_year_from_matrix(curr_avg=by_date.loc[by_date['data'].dt.year == curr_year],
+                                            matrix=yearly_matrix, curr_year=curr_year, comp_years=comp_years)
     display_plotly_timestamp(lines=year_on_year, use_st=use_st)
 
 
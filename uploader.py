@@ -1,9 +1,14 @@
 import argparse
 import logging
 
+from src.config import ARPA_DATA_DIR, WT_DATA_DIR, ARPA_WATERMARK_PATH, WT_MANIFEST_PATH, DASHBOARD_DIR
 from src.data.arpa.make_arpa import make_arpa_dataset
 from src.data.make_dataset import make_dataset
+from src.data.storage import dataset_path
 from src.data.weather.make_weather import make_weather_dataset
+from src.instrumentation import RunReport
+from src.pipeline import Stage, PipelineRunner
+from src.visualization.dashboard import build_dashboard_aggregates
 from src.models.normalize_weather import predict_normalized_pollutant
 
 
@@ -15,20 +20,80 @@ def parse_args():
     parser.add_argument("-d", "--daily",
                         help="[False] daily data are considered instead of hourly",
                         required=False, default=False, action="store_true")
+    parser.add_argument("--hourly",
+                        help="[False] hourly data are kept by hour instead of being averaged by day",
+                        required=False, default=False, action="store_true")
+    parser.add_argument("--full",
+                        help="[False] ARPA data are downloaded and rewritten as a whole instead of being synced from "
+                             "the last stored measures; always the case with -b or when no ARPA data are stored yet",
+                        required=False, default=False, action="store_true")
+    parser.add_argument("-y", "--years", nargs='+', type=int, default=None,
+                        help="[all] only these years of ARPA data are rebuilt and upserted into the stored ones")
+    parser.add_argument("--only", nargs='+', default=None, choices=STAGE_NAMES,
+                        help="[all] run only these stages, using the current outputs of the others")
+    parser.add_argument("--force", nargs='*', default=None, choices=STAGE_NAMES,
+                        help="[none] run these stages, or every stage if none is given, even if up to date")
     args = parser.parse_args()
     parms = {
         "build_historical": args.build_history,
-        "use_daily": args.daily
+        "use_daily": args.daily,
+        "hourly": args.hourly,
+        "incremental": not (args.full or args.build_history),
+        "years": args.years,
+        "only": args.only,
+        "force": args.force
     }
     return parms
 
 
-def main(build_historical: bool, use_daily: bool, **kwargs):
+def refresh_stages(build_historical: bool = False, use_daily: bool = False, incremental: bool = True,
+                   hourly: bool = False, years: list = None) -> list:
+    """
+    Stages of the refresh with the files they read and write. ARPA and weather stages download data, so they always
+    run, concurrently as they share no input; they only write new or changed data, so that the following stages,
+    which run only if the processed data they read changed, are skipped by a refresh without news. The last one
+    materializes the aggregates shown by app.py.
+    """
+    return [
+        Stage('arpa', lambda: make_arpa_dataset(build_historical=build_historical, incremental=incremental,
+                                                years=years),
+              inputs=[ARPA_DATA_DIR], outputs=[dataset_path('arpa_data'), ARPA_WATERMARK_PATH], remote=True),
+        Stage('weather', make_weather_dataset,
+              inputs=[WT_DATA_DIR], outputs=[dataset_path('weather_data'), WT_MANIFEST_PATH], remote=True),
+        Stage('dataset', lambda: make_dataset(use_daily=use_daily, hourly=hourly),
+              inputs=[dataset_path('arpa_data'), dataset_path('weather_data')],
+              outputs=[dataset_path('dataset'), dataset_path('date_dimension')],
+              deps=['arpa', 'weather'], params={'use_daily': use_daily, 'hourly': hourly}),
+        Stage('normalize', predict_normalized_pollutant,
+              inputs=[dataset_path('dataset'), dataset_path('date_dimension')],
+              outputs=[dataset_path('normalized_dataset')], deps=['dataset']),
+        Stage('dashboard', build_dashboard_aggregates,
+              inputs=[dataset_path('dataset'), dataset_path('normalized_dataset')], outputs=[DASHBOARD_DIR],
+              deps=['normalize'])
+    ]
+
+
+STAGE_NAMES = [stage.name for stage in refresh_stages()]
+
+
+def main(build_historical: bool, use_daily: bool, incremental: bool = True, hourly: bool = False,
+         years: list = None, only: list = None, force: list = None, **kwargs):
+    """
+    Update data and normalize every sensor, skipping stages whose inputs did not change since their last successful
+    run (see src.pipeline). Time, memory and rows of each stage and sensor are saved as a json run report; set
+    POLLUTION_PROFILE to a stage name (e.g. 'normalize' or 'normalize:tracemalloc') to profile it.
+    """
     logging.info("Updating data and executing the normalization pipeline")
-    make_arpa_dataset(build_historical=build_historical)
-    make_weather_dataset()
-    make_dataset(use_daily=use_daily)
-    predict_normalized_pollutant()
+    params = {'build_historical': build_historical, 'use_daily': use_daily, 'incremental': incremental,
+              'hourly': hourly, 'years': years, 'only': only, 'force': force}
+    stages = refresh_stages(build_historical=build_historical, use_daily=use_daily, incremental=incremental,
+                            hourly=hourly, years=years)
+    with RunReport(name='refresh', params=params) as report:
+        outcomes = PipelineRunner(stages=stages, report=report).run(only=only, force=force)
+        report.report['outcomes'] = outcomes
+        failed = [name for name, outcome in outcomes.items() if outcome in ('failed', 'blocked')]
+        if len(failed) > 0:
+            raise RuntimeError("stages {f} did not complete".format(f=failed))
 
 
 if __name__ == '__main__':